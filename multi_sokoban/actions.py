@@ -1,6 +1,10 @@
 """Define literals and actions schemas for the muli-PDDL framework."""
 import copy
+import itertools
 import operator
+import random
+from array import array
+from bisect import bisect_right
 from typing import Dict
 
 import numpy as np
@@ -8,57 +12,589 @@ import numpy as np
 from utils import println
 
 
+class Zobrist(dict):
+    """Random 64-bit keys of (object key, color, position), drawn on demand.
+
+    The index of a box is left out on purpose: boxes with the same letter
+    and color are interchangeable, so permutations of them hash the same.
+    """
+
+    def __missing__(self, key):
+        value = self[key] = random.getrandbits(64)
+        return value
+
+
+# shared by every state so that hashes agree across copies of a problem
+ZOBRIST = Zobrist()
+
+# codes of the static layer of the map, agents and boxes live in `occupied`
+FREE = 0
+WALL = 1
+
+DIRECTIONS = {"N": (-1, 0), "E": (0, 1), "S": (1, 0), "W": (0, -1)}
+
+
+def _actionTable():
+    """Enumerate the actions: (name, first step, second step) and command."""
+    actions, commands = [("NoOp", None, None)], ["NoOp"]
+    for d1, step1 in DIRECTIONS.items():
+        actions.append(("Move", step1, None))
+        commands.append(f"Move({d1})")
+    for name in ("Push", "Pull"):
+        for d1, step1 in DIRECTIONS.items():
+            for d2, step2 in DIRECTIONS.items():
+                actions.append((name, step1, step2))
+                commands.append(f"{name}({d1},{d2})")
+    return actions, commands
+
+
+# plans are array("B") of opcodes, indices into these tables; the steps are
+# the (drow, dcol) of the two directions of the server command, which is
+# only looked up in COMMANDS when the plan is sent
+ACTIONS, COMMANDS = _actionTable()
+OPCODES = {action: code for code, action in enumerate(ACTIONS)}
+NOOP = OPCODES["NoOp", None, None]
+
+
+def opcode(actionPerformed) -> int:
+    """Return the opcode of the `actionPerformed` of a state."""
+    name, params = actionPerformed
+    if name == "Move":
+        _, agtfrom, agtto = params
+        steps = (agtto[0] - agtfrom[0], agtto[1] - agtfrom[1]), None
+    elif name == "Push":
+        _, _, agtfrom, boxfrom, boxto, _ = params
+        steps = (
+            (boxfrom[0] - agtfrom[0], boxfrom[1] - agtfrom[1]),
+            (boxto[0] - boxfrom[0], boxto[1] - boxfrom[1]),
+        )
+    elif name == "Pull":
+        _, _, agtfrom, agtto, boxfrom, _ = params
+        steps = (
+            (agtto[0] - agtfrom[0], agtto[1] - agtfrom[1]),
+            (boxfrom[0] - agtfrom[0], boxfrom[1] - agtfrom[1]),
+        )
+    else:
+        return NOOP
+    return OPCODES[(name, *steps)]
+
+
+class LevelContext:
+    """Rigid data of a level, shared by every node of a search."""
+
+    __slots__ = (
+        "dir",
+        "deltaPos",
+        "_goals",
+        "agentColor",
+        "layout",
+        "explored",
+        "walked",
+        "bitboards",
+        "goalCells",
+        "movable",
+        "steps",
+        "macros",
+        "tunnels",
+        "rooms",
+        "skipped",
+        "sipp",
+        "dead",
+        "frozen",
+        "distances",
+    )
+
+    # larger goal rooms are left to the search, see buildGoalRooms()
+    max_room = 64
+
+    def __init__(self):
+        """Initialize an empty level."""
+        self.dir = {"N": (-1, 0), "E": (0, 1), "S": (1, 0), "W": (0, -1)}
+        self.deltaPos = {
+            (-1, 0): "N",
+            (0, 1): "E",
+            (1, 0): "S",
+            (0, -1): "W",
+        }
+        self.goals = {}  # hashtable
+        self.agentColor = {}  # hashtable
+        self.layout = None  # static layer of the map, uint8 codes
+        self.explored = {}  # hash -> list of (agents, boxes)
+        self.walked = {}  # agent -> cells the push-level search walked to
+        self.bitboards = None  # built on demand by StateBitboard
+        self.goalCells = None  # built on demand by Literals.goalTally
+        self.movable = None  # color -> box letters, built on demand
+        self.steps = None  # grounded operators, built on demand by explore
+        self.macros = False  # follow tunnels in a single successor
+        self.tunnels = None  # built on demand when macros are on
+        self.rooms = None  # goal rooms, built on demand when macros are on
+        self.skipped = 0  # explored children that were never allocated
+        self.sipp = False  # concurrent agents wait through safe intervals
+        self.dead = None  # letter -> cells with no way to a goal, on demand
+        self.frozen = False  # set by Agent.search while a frozen task only walks
+        self.distances = None  # walking distances, built with the level
+
+    def invalidate(self):
+        """Drop the data derived from the walls and the goals."""
+        self.bitboards = None
+        self.goalCells = None
+        self.steps = None
+        self.tunnels = None
+        self.rooms = None
+        self.dead = None
+
+    def buildGoalCells(self):
+        """Map every goal cell to its box letter and its bit in `goalsMet`."""
+        self.goalCells = {}
+        for key, goals in self._goals.items():
+            for pos, _ in goals:
+                self.goalCells[pos] = (key.upper(), 1 << len(self.goalCells))
+        return self.goalCells
+
+    def buildSteps(self):
+        """Ground the steps of Move, Push and Pull on every free cell.
+
+        A step maps a cell to its neighbour in each direction of `dir`, in
+        order, with None where the neighbour is a wall or off the map. Each
+        grounded operator is a chain of steps: Move and Pull step the agent,
+        Push steps the box, so no positions are added up while expanding.
+        """
+        rows, cols = self.layout.shape
+        free = self.layout != WALL
+        self.steps = {}
+        for row, col in zip(*np.nonzero(free)):
+            row, col = int(row), int(col)
+            neighbours = []
+            for dr, dc in self.dir.values():
+                r, c = row + dr, col + dc
+                inside = 0 <= r < rows and 0 <= c < cols
+                neighbours.append((r, c) if inside and free[r, c] else None)
+            self.steps[row, col] = tuple(neighbours)
+        return self.steps
+
+    def buildTunnels(self):
+        """Find the cells of the 1-wide corridors of the level.
+
+        A tunnel cell is a free cell with exactly two free neighbours that
+        holds no goal; it maps to those two neighbours. Walking, pushing or
+        pulling along such cells leaves nothing to decide until the end of
+        the corridor, so the macro actions of `StateInit` go through them in
+        a single successor.
+        """
+        steps = self.steps if self.steps is not None else self.buildSteps()
+        goals = {tuple(pos) for goals in self._goals.values() for pos, _ in goals}
+        self.tunnels = {}
+        for cell, neighbours in steps.items():
+            free = tuple(pos for pos in neighbours if pos is not None)
+            if len(free) == 2 and cell not in goals:
+                self.tunnels[cell] = free
+        return self.tunnels
+
+    def buildGoalRooms(self):
+        """Find the rooms of goals entered through a single tunnel cell.
+
+        A room is a connected set of free cells, tunnel cells left out, that
+        holds goals and borders a single tunnel cell, its entrance. Its goals
+        are filled in a fixed order: the goal farthest from the entrance
+        whose box leaves the other cells of the room connected to the
+        entrance comes first. Rooms with no such order or with more than
+        `max_room` cells are left out. Each room cell maps to its room, a
+        tuple of the entrance, the room cells and the goals in their order
+        as (cell, box letter).
+        """
+        tunnels = self.tunnels if self.tunnels is not None else self.buildTunnels()
+        goals = {
+            tuple(pos): key.upper()
+            for key, goals in self._goals.items()
+            for pos, _ in goals
+        }
+        self.rooms = {}
+        seen = set()
+        for start in goals:
+            # goals under boxes no agent moves are walls
+            if start in seen or start not in self.steps:
+                continue
+            cells = {start}
+            doors = set()
+            frontier = [start]
+            for cell in frontier:
+                for pos in self.steps[cell]:
+                    if pos is None or pos in cells:
+                        continue
+                    if pos in tunnels:
+                        doors.add(pos)
+                    else:
+                        cells.add(pos)
+                        frontier.append(pos)
+            seen |= cells
+            if len(doors) != 1 or len(cells) > self.max_room:
+                continue
+            (entrance,) = doors
+            order = self.__fillOrder(entrance, cells, goals)
+            if order:
+                room = (entrance, frozenset(cells), order)
+                self.rooms.update(dict.fromkeys(cells, room))
+        return self.rooms
+
+    def __fillOrder(self, entrance, cells, goals):
+        # returns the goals of the room `cells` in the order they are filled,
+        # empty if a box on any goal left would cut another one off
+        def distances(cells):
+            dist = {entrance: 0}
+            frontier = [entrance]
+            for cell in frontier:
+                for pos in self.steps[cell]:
+                    if pos in cells and pos not in dist:
+                        dist[pos] = dist[cell] + 1
+                        frontier.append(pos)
+            return dist
+
+        open_ = cells | {entrance}
+        left = {cell for cell in cells if cell in goals}
+        order = []
+        while left:
+            dist = distances(open_)
+            for goal in sorted(left, key=lambda cell: -dist.get(cell, -1)):
+                rest = open_ - {goal}
+                if goal in dist and len(distances(rest)) == len(rest):
+                    break
+            else:
+                return ()
+            order.append((goal, goals[goal]))
+            open_ = rest
+            left.remove(goal)
+        return tuple(order)
+
+    def buildDeadCells(self, boxes):
+        """Find the cells a box can never leave for a goal of its letter.
+
+        A box moves to a free neighbour if it can be pushed there, with the
+        agent on another free side of the box, or pulled there, with the
+        agent stepping on to another free cell. Other objects are ignored,
+        so the cells that reach no goal by walking those moves backwards
+        from the goals are dead for good. Only letters with no more boxes
+        in `boxes` than goals get dead cells: a spare box may have to be
+        parked anywhere, and letters without boxes are left out.
+        """
+        steps = self.steps if self.steps is not None else self.buildSteps()
+        sources = {cell: [] for cell in steps}  # cell -> cells a box comes from
+        for cell, neighbours in steps.items():
+            free = [pos for pos in neighbours if pos is not None]
+            for pos in free:
+                pushed = len(free) > 1
+                pulled = any(other not in (None, cell) for other in steps[pos])
+                if pushed or pulled:
+                    sources[pos].append(cell)
+        self.dead = {}
+        for key, goals in self._goals.items():
+            letter = key.upper()
+            if not 0 < len(boxes.get(letter, ())) <= len(goals):
+                continue
+            alive = {tuple(pos) for pos, _ in goals}
+            frontier = list(alive)
+            for cell in frontier:
+                for source in sources.get(cell, ()):
+                    if source not in alive:
+                        alive.add(source)
+                        frontier.append(source)
+            self.dead[letter] = frozenset(steps.keys() - alive)
+        return self.dead
+
+    @property
+    def goals(self):
+        """Goals of the level, letter -> list of [pos, color]."""
+        return self._goals
+
+    @goals.setter
+    def goals(self, goals):
+        self._goals = goals
+        self.invalidate()
+
+
+class Bitboards:
+    """Rigid bitboards of a level, one bit per cell in row-major order."""
+
+    __slots__ = ("cols", "walls", "goals")
+
+    def __init__(self, context: LevelContext):
+        """Pack the walls and the goals of every letter of `context`."""
+        self.cols = context.layout.shape[1]
+        self.walls = self.pack(zip(*np.nonzero(context.layout == WALL)))
+        self.goals = {
+            key.upper(): self.pack(pos for pos, _ in goals)
+            for key, goals in context.goals.items()
+        }
+
+    def bit(self, pos) -> int:
+        """Return the bitboard of the single cell `pos`."""
+        return 1 << int(pos[0] * self.cols + pos[1])
+
+    def pack(self, positions) -> int:
+        """Return the bitboard of the cells `positions`."""
+        board = 0
+        for pos in positions:
+            board |= self.bit(pos)
+        return board
+
+
+class Occupancy:
+    """Dynamic layer of the map stored as a delta on the parent's layer.
+
+    A node only records the cells its effects touched, with None marking a
+    vacated cell, and reads walk up the parents until a layer knows the
+    cell. Every `snapshotEvery` levels `copy()` flattens the chain into a
+    full snapshot, so a read visits at most `snapshotEvery` layers and the
+    memory of a node does not grow with the number of boxes.
+    """
+
+    __slots__ = ("parent", "delta", "depth")
+    snapshotEvery = 8
+
+    def __init__(self, cells=None, parent=None):
+        """Initialize a snapshot of `cells` or an empty delta on `parent`."""
+        self.parent = parent
+        self.delta = dict(cells) if cells else {}
+        self.depth = parent.depth + 1 if parent is not None else 0
+
+    def get(self, pos, default=None):
+        """Return the key of the object at `pos`, `default` if it is free."""
+        layer = self
+        while layer is not None:
+            if pos in layer.delta:
+                key = layer.delta[pos]
+                return default if key is None else key
+            layer = layer.parent
+        return default
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    def __getitem__(self, pos):
+        key = self.get(pos)
+        if key is None:
+            raise KeyError(pos)
+        return key
+
+    def __setitem__(self, pos, key):
+        self.delta[pos] = key
+
+    def __delitem__(self, pos):
+        self[pos]  # raises KeyError like a dict
+        self.delta[pos] = None
+
+    def pop(self, pos, default=None):
+        """Vacate `pos` and return the key of the object that was there."""
+        key = self.get(pos)
+        if key is None:
+            return default
+        self.delta[pos] = None
+        return key
+
+    def items(self):
+        """Return the (pos, key) pairs of the materialized layer."""
+        return self.flatten().items()
+
+    def flatten(self) -> Dict:
+        """Materialize the layer as a dict pos -> key."""
+        deltas = []
+        layer = self
+        while layer is not None:
+            deltas.append(layer.delta)
+            layer = layer.parent
+        cells = {}
+        for delta in reversed(deltas):
+            cells.update(delta)
+        return {pos: key for pos, key in cells.items() if key is not None}
+
+    def copy(self):
+        """Return the layer of a child, a snapshot every `snapshotEvery`."""
+        if self.depth + 1 >= self.snapshotEvery:
+            return Occupancy(self.flatten())
+        return Occupancy(parent=self)
+
+
+class Timeline:
+    """Immutable, time-sorted changes of the world made by other agents.
+
+    It is built once from a concurrent table {t: {key: [pos, index]}} and
+    shared by every node of a search, which only query it: the changes of
+    a time and the cells taken at a time are hashed and the next change
+    after a time is a bisection of the sorted times. Each change also
+    carries the position the object had at its previous change, so agents
+    that are not in the records are moved without scanning `occupied`.
+
+    The sorted arrival times of each cell split its time line in safe
+    intervals, the stretches in which no other object enters the cell.
+    """
+
+    __slots__ = ("table", "times", "events", "taken", "busy")
+
+    def __init__(self, concurrent: Dict):
+        """Sort and index the concurrent table `concurrent`."""
+        self.table = {t: dict(changes) for t, changes in concurrent.items()}
+        self.times = tuple(sorted(self.table))
+        self.events = {}
+        taken, last, busy = set(), {}, {}
+        for t in self.times:
+            changes = []
+            for key, (pos, index) in self.table[t].items():
+                changes.append((key, pos, index, last.get((key, index))))
+                last[key, index] = pos
+                if pos is not None:
+                    taken.add((t, pos))
+                    busy.setdefault(pos, []).append(t)
+            self.events[t] = tuple(changes)
+        self.taken = frozenset(taken)
+        self.busy = {pos: tuple(times) for pos, times in busy.items()}
+
+    def __contains__(self, t):
+        return t in self.events
+
+    def __len__(self):
+        return len(self.times)
+
+    def after(self, t):
+        """Return the time of the first change after `t`, None if there is none."""
+        i = bisect_right(self.times, t)
+        return self.times[i] if i < len(self.times) else None
+
+    def epoch(self, t) -> int:
+        """Return the number of changes of the world up to time `t`."""
+        return bisect_right(self.times, t)
+
+    def isTaken(self, t, pos) -> bool:
+        """Tell if some object of another agent is at `pos` at time `t`."""
+        return (t, pos) in self.taken
+
+    def safeUntil(self, t, pos):
+        """Return the last time of the safe interval of `pos` holding `t`."""
+        busy = self.busy.get(pos, ())
+        i = bisect_right(busy, t)
+        return busy[i] - 1 if i < len(busy) else float("inf")
+
+    def merged(self, concurrent: Dict):
+        """Return a new timeline with the changes of `concurrent` added."""
+        table = {t: dict(changes) for t, changes in self.table.items()}
+        for t, changes in concurrent.items():
+            table[t] = {**table.get(t, {}), **changes}
+        return Timeline(table)
+
+
+def sameRecords(agents, boxes, otherAgents, otherBoxes) -> bool:
+    """Tell if two sets of agent and box records describe the same state.
+
+    Boxes with the same letter and color are interchangeable, so the boxes
+    of a letter are compared as a multiset of (pos, color).
+    """
+    if agents != otherAgents:
+        return False
+    if boxes == otherBoxes:
+        return True
+    for key, records in boxes.items():
+        if records != otherBoxes[key] and sorted(records) != sorted(otherBoxes[key]):
+            return False
+    return True
+
+
+def _shared(name):
+    """Expose the attribute `name` of the LevelContext on the nodes."""
+    return property(
+        lambda self: getattr(self.context, name),
+        lambda self, value: setattr(self.context, name, value),
+    )
+
+
 class Literals:
+    # nodes only hold what changes from one state to the next,
+    # the rest lives in the LevelContext shared by the whole search
+    __slots__ = (
+        "context",
+        "agents",
+        "boxes",
+        "occupied",
+        "hash",
+        "prevState",
+        "actionPerformed",
+        "g",
+        "t",
+        "h",
+        "f",
+        "trajectories",
+        "goalCells",
+        "unsatisfied",
+        "goalsMet",
+    )
+
+    dir = _shared("dir")
+    deltaPos = _shared("deltaPos")
+    goals = _shared("goals")
+    agentColor = _shared("agentColor")
+    layout = _shared("layout")
+    explored = _shared("explored")
+    walked = _shared("walked")
+
     def __init__(self, parent: "Literals" = None):
         # initializes the literals
+        # agents and boxes are persistent: each key maps to a tuple of
+        # (pos, color) records that is never mutated, effects replace the
+        # record instead so children share every untouched tuple with the parent
         if parent is None:
             # if no parent is present!
-            self.dir = {"N": (-1, 0), "E": (0, 1), "S": (1, 0), "W": (0, -1)}
-            self.deltaPos = {
-                (-1, 0): "N",
-                (0, 1): "E",
-                (1, 0): "S",
-                (0, -1): "W",
-            }
-            self.goals = {}  # hashtable
-            self.agentColor = {}  # hashtable
+            self.context = LevelContext()
             self.agents = {}  # hashtable
             self.boxes = {}  # hashtable
+            self.occupied = {}  # dynamic layer of the map, pos -> object key
+            self.hash = 0  # zobrist hash of agents and boxes
+            self.goalCells = None  # goal cells the tally below refers to
+            self.unsatisfied = None  # goals without a box of their letter
+            self.goalsMet = None  # bitmask of the goals with their box
             self.prevState = None
             self.actionPerformed = None
             self.g = 0
             self.t = 0
-            self.h = None
-            self.f = None
-            self.explored = set()
         else:
             # if a parent is present!
-            self.dir = parent.dir  # rigid
-            self.deltaPos = parent.deltaPos  # rigid
-            self.goals = parent.goals  # rigid
-            self.agentColor = parent.agentColor  # rigid
-            # TODO avoid deepcopies
-            self.agents = copy.deepcopy(parent.agents)
-            self.boxes = copy.deepcopy(parent.boxes)
-            self.map = parent.map.copy()
+            self.context = parent.context  # rigid
+            # shallow copies, the position records are shared with the parent
+            self.agents = parent.agents.copy()
+            self.boxes = parent.boxes.copy()
+            self.occupied = parent.occupied.copy()
+            self.hash = parent.hash  # updated by the effects
+            self.goalCells = parent.goalCells  # the tally is updated by the effects
+            self.unsatisfied = parent.unsatisfied
+            self.goalsMet = parent.goalsMet
             self.prevState = parent  # reference to previous state
             self.actionPerformed = None  # gets defined when action is chosen
             self.g = parent.g + 1
-            self.h = None
-            self.f = None
             self.t = parent.t + 1
-            self.explored = parent.explored
+        self.h = None
+        self.f = None
+        self.trajectories = None  # (key, index) -> (t, pos), see trajectory()
         super().__init__()
 
     def addMap(self, map2):
         # initialized a map with only walls
-        self.map = np.array(map2)
+        self.layout = np.where(np.array(map2) == "+", WALL, FREE).astype(np.uint8)
+
+    def addWall(self, pos):
+        # turns a position of the map into a wall
+        self.layout[pos] = WALL
+        self.context.invalidate()
+
+    @property
+    def map(self):
+        # renders the static and the dynamic layer (debugging and drawing)
+        map = np.where(self.layout == WALL, "+", " ")
+        for pos, key in self.occupied.items():
+            map[pos] = key
+        return map
 
     def addAgent(self, key, pos, color="c"):
         # Adds an agent to the map and to a hashtable
         # key is the agent number and color is the color of the agent
-        self.map[pos] = key
-        self.agents[key] = [[pos, color]]
+        self.occupied[pos] = key
+        self.agents[key] = ((pos, color),)
+        self.hash ^= ZOBRIST[key, color, pos]
 
         # This is only used to get easy access to agents by color
         if color not in self.agentColor:
@@ -74,38 +610,48 @@ class Literals:
             self.goals[key] = [[pos, color]]
         else:
             self.goals[key].append([pos, color])
+        self.context.invalidate()
 
     def addBox(self, key, pos, color="c"):
         # Adds a box to the map and to a hashtable
         # key is a letter
         key = key.upper()
-        self.map[pos] = key
+        self.occupied[pos] = key
         if key not in self.boxes:
-            self.boxes[key] = [[pos, color]]
+            self.boxes[key] = ((pos, color),)
         else:
-            self.boxes[key].append([pos, color])
+            self.boxes[key] += ((pos, color),)
+        self.hash ^= ZOBRIST[key, color, pos]
+        self.goalCells = None  # recount the goal tally
+        self.context.movable = None
+        self.context.dead = None  # one more box may be a spare one
 
     def forget_exploration(self):
         """Remove explored nodes."""
-        self.explored = set()
+        self.explored = {}
+        self.walked = {}
 
     def deleteAgent(self, external_key):
         """Delete from `agents`, the `map` and `agent_color`."""
-        pos = self.getPos(self.agents, external_key)
+        pos, color = self.agents[external_key][0]
         del self.agents[external_key]
-        self.map[pos] = " "
+        self.occupied.pop(pos, None)
+        self.hash ^= ZOBRIST[external_key, color, pos]
         for color in self.agentColor:
             if external_key in self.agentColor[color]:
                 to_del = self.agentColor[color].index(external_key)
                 del self.agentColor[color][to_del]
 
     def deleteBox(self, external_key):
-        pos = self.getPos(self.boxes, external_key)
+        for pos, color in self.boxes[external_key]:
+            self.occupied.pop(pos, None)
+            self.hash ^= ZOBRIST[external_key, color, pos]
         del self.boxes[external_key]
-        self.map[pos] = " "
+        self.goalCells = None  # recount the goal tally
 
     def deleteGoal(self, external_key):
         del self.goals[external_key]
+        self.context.invalidate()
 
     def keepJustAgent(self, external_key):
         ext_agents = list(self.agents.keys())
@@ -137,18 +683,40 @@ class Literals:
         # sets the position of an object
         # setPos(objecttype, the key, position, the index (if multiple))
         # returns None if not in hashtable
-        if type(objtype[obj][i][0]) == tuple:
-            objtype[obj][i][0] = pos
+        records = objtype[obj]
+        if type(records[i][0]) == tuple:
+            prev, color = records[i]
+            objtype[obj] = records[:i] + ((pos, color),) + records[i + 1 :]
+            self.hash ^= ZOBRIST[obj, color, prev] ^ ZOBRIST[obj, color, pos]
+            if self.goalCells is not None and objtype is self.boxes:
+                # a box leaving or entering a goal of its letter
+                goal = self.goalCells.get(prev)
+                if goal is not None and goal[0] == obj:
+                    self.unsatisfied += 1
+                    self.goalsMet ^= goal[1]
+                goal = self.goalCells.get(pos)
+                if goal is not None and goal[0] == obj:
+                    self.unsatisfied -= 1
+                    self.goalsMet |= goal[1]
         else:
             return None
 
     def Free(self, pos):
         # checks if position in map is free
         # returns true if it is free and false otherwise
-        if self.map[pos] == chr(32) or self.map[pos].islower():
-            return True
-        else:
+        if pos in self.occupied or self.context.layout[pos] == WALL:
             return False
+        else:
+            return True
+
+    def clone(self):
+        # returns a sibling of the state sharing the same parent
+        # only the containers are copied, the position records are shared
+        other = copy.copy(self)
+        other.agents = self.agents.copy()
+        other.boxes = self.boxes.copy()
+        other.occupied = self.occupied.copy()
+        return other
 
     def Color(self, obj):
         pass
@@ -166,6 +734,8 @@ class Literals:
 
 
 class StateInit(Literals):
+    __slots__ = ()
+
     def __init__(self, parent: "Literals" = None):
         # initializes the state
         # it is (row, column) and not (x, y)
@@ -216,11 +786,6 @@ class StateInit(Literals):
         # simply adds two positions together
         return tuple(map(operator.add, agtfrom, self.dir[agtdir]))
 
-    def __getDir(self, agtfrom, agtto):
-        # returns the direction the agent moved
-        dir = (agtto[0] - agtfrom[0], agtto[1] - agtfrom[1])
-        return self.deltaPos[dir]
-
     def __MovePrec(self, agt, agtdir):
         # returns the movement parameters if the preconditions are met
         # otherwise it returns 0
@@ -242,8 +807,8 @@ class StateInit(Literals):
         # Moves the object with the given parameters
         # Does not check preconditions
         self.setPos(self.agents, agt, agtto)
-        self.map[agtfrom] = chr(32)
-        self.map[agtto] = agt
+        self.occupied.pop(agtfrom, None)
+        self.occupied[agtto] = agt
         # print("Agent " + agt + " is now at " + str(agtto) + " (row,col)")
         return True
 
@@ -285,9 +850,9 @@ class StateInit(Literals):
         # Does not check preconditions
         self.setPos(self.agents, agt, boxfrom, 0)  # agents are unique thus 0
         self.setPos(self.boxes, boxkey, boxto, i)
-        self.map[agtfrom] = chr(32)
-        self.map[boxfrom] = agt
-        self.map[boxto] = boxkey
+        self.occupied.pop(agtfrom, None)
+        self.occupied[boxfrom] = agt
+        self.occupied[boxto] = boxkey
         # print("Agent " + agt + " is now at " + str(boxto) + " (row,col)")
         # print("Box " + str(box) + " is now at " + str(boxfrom) + " (row,col)")
         return True
@@ -330,9 +895,9 @@ class StateInit(Literals):
         # Does not check preconditions
         self.setPos(self.agents, agt, agtto, 0)  # agents are unique thus 0
         self.setPos(self.boxes, boxkey, agtfrom, i)
-        self.map[boxfrom] = chr(32)
-        self.map[agtfrom] = boxkey
-        self.map[agtto] = agt
+        del self.occupied[boxfrom]
+        self.occupied[agtfrom] = boxkey
+        self.occupied[agtto] = agt
         # print("Agent " + agt + " is now at " + str(agtto) + " (row,col)")
         # print("Box " + str(box) + " is now at " + str(agtfrom) + " (row,col)")
         return True
@@ -345,140 +910,396 @@ class StateInit(Literals):
         else:
             return None
 
-    def minimalRep(self):
-        # returns the minimal representation of the states
-        return str([self.agents, self.boxes])
+    def sameAs(self, agents, boxes):
+        # returns true if the records describe the same state
+        return sameRecords(self.agents, self.boxes, agents, boxes)
 
     def isExplored(self):
         # returns true if the state is explored
-        return self.minimalRep() in self.explored
+        # the hash only selects the candidates, collisions are ruled out by
+        # comparing the records themselves
+        for agents, boxes in self.explored.get(self.hash, ()):
+            if self.sameAs(agents, boxes):
+                return True
+        return False
 
     def __addToExplored(self, children):
         # adds the state to the explored list
         if not self.isExplored():
-            self.explored.add(self.minimalRep())
+            self.explored.setdefault(self.hash, []).append(self.records())
             children.append(self)
 
+    def deadlocked(self):
+        # returns the cells of the cluster of a box that has to reach a goal and
+        # is frozen off the goals of its letter, empty if there is none; a push is
+        # undone by a pull and the other way round, so moves never freeze a box
+        # and only the state a search starts from is checked
+        needed = self.deadCells
+        cells = self.context.goalCells
+        if cells is None:
+            cells = self.context.buildGoalCells()
+        for key in needed:
+            for pos, _ in self.boxes[key]:
+                goal = cells.get(pos)
+                cluster = set()
+                if (goal is None or goal[0] != key) and self.__frozen(pos, cluster):
+                    return frozenset(cluster)
+        return frozenset()
+
+    # boxes looked at by a freeze check before giving up
+    freezeLimit = 8
+
+    def __frozen(self, pos, cluster):
+        # tells if the box at pos can never move again: with pulls, a box moves
+        # only on to a neighbour cell, so every neighbour must be a wall, a box no
+        # agent of the task can move or a frozen box; the boxes of the cluster
+        # count as walls while the neighbours of the others are looked at
+        cluster.add(pos)
+        if len(cluster) > self.freezeLimit:
+            return False
+        for cell in self.steps[pos]:
+            if cell is None or cell in cluster:
+                continue
+            key = self.occupied.get(cell)
+            if key is None or key.isnumeric():
+                return False  # free, or an agent that can step away
+            if not self.agentColor.get(self.boxes[key][0][1]):
+                continue  # no agent of its color, a wall
+            if not self.__frozen(cell, cluster):
+                return False
+        return True
+
+    def records(self):
+        # returns the (agents, boxes) records the explored table keeps
+        return self.agents, self.boxes
+
+    def goalTally(self):
+        # returns the number of unsatisfied goals and the bitmask of the met ones
+        # the tally is counted once and then kept up to date by setPos
+        cells = self.context.goalCells
+        if cells is None:
+            cells = self.context.buildGoalCells()
+        if self.goalCells is not cells:
+            self.goalCells = cells
+            self.unsatisfied = len(cells)
+            self.goalsMet = 0
+            for key, records in self.boxes.items():
+                for pos, _ in records:
+                    goal = cells.get(pos)
+                    if goal is not None and goal[0] == key:
+                        self.unsatisfied -= 1
+                        self.goalsMet |= goal[1]
+        return self.unsatisfied, self.goalsMet
+
     def isGoalState(self):
         # checks if the state is a goal state
-        keys = self.getGoalKeys()
-        for key in keys:
-            goals = self.getGoalsByKey(key)
-            for pos, color in goals:
-                if self.map[pos] != key.upper():
-                    return False
-        return True
+        return self.goalTally()[0] == 0
+
+    def trajectory(self, looking_for, index=0):
+        # returns the (t, pos) of an object for every action leading to the state
+        # it walks the parent links once and caches the result on this state
+        if self.trajectories is None:
+            self.trajectories = {}
+        if (looking_for, index) not in self.trajectories:
+            obj_group = "agents" if looking_for.isnumeric() else "boxes"
+            trace = []
+            state = self
+            while state.actionPerformed is not None:
+                objtype = getattr(state, obj_group)
+                trace.append((state.t, state.getPos(objtype, looking_for, index)))
+                state = state.prevState
+            self.trajectories[looking_for, index] = tuple(trace[::-1])
+        return self.trajectories[looking_for, index]
 
     def bestPath(self, format=0, index=0):
         # function returns the list of actions used to reach the state
+        # the states are only read, so the parent links are walked without copies
         path = []
-        state = copy.deepcopy(self)
+        state = self
         if format == 1:
             # format used by actions
             while state.actionPerformed is not None:
                 path.append(state.actionPerformed)
                 state = state.prevState
         elif isinstance(format, str):
-            # trace back an object
-            looking_for = format
-            obj_group = "agents" if format.isnumeric() else "boxes"
-
-            while state.actionPerformed is not None:
-                path.append(
-                    [
-                        state.t,
-                        state.getPos(getattr(state, obj_group), looking_for, index),
-                    ]
-                )
-                state = state.prevState
+            # trace back an object, callers get their own [t, pos] lists
+            return [[t, pos] for t, pos in self.trajectory(format, index)]
         else:
-            # format used by server
+            # format used by server, opcodes of COMMANDS
             while state.actionPerformed is not None:
-                # print(state.actionPerformed, state.actionPerformed[0])
-                cmd = state.actionPerformed[0]
-                if cmd == "Push":  # (agtfrom, boxfrom, boxto)
-                    parm1 = self.__getDir(
-                        state.actionPerformed[1][2], state.actionPerformed[1][3]
-                    )
-                    parm2 = self.__getDir(
-                        state.actionPerformed[1][3], state.actionPerformed[1][4]
-                    )
-                    cmd = f"Push({parm1},{parm2})"
-                elif cmd == "Pull":  # (agtfrom, agtto, boxfrom)
-                    parm1 = self.__getDir(
-                        state.actionPerformed[1][2], state.actionPerformed[1][3]
-                    )
-                    parm2 = self.__getDir(
-                        state.actionPerformed[1][2], state.actionPerformed[1][4]
-                    )
-                    cmd = f"Pull({parm1},{parm2})"
-                elif cmd == "Move":
-                    parm1 = self.__getDir(
-                        state.actionPerformed[1][1], state.actionPerformed[1][2]
-                    )
-                    cmd = f"Move({parm1})"
-                elif cmd == "NoOp":
-                    cmd = "NoOp"
-
-                path.append(cmd)
+                path.append(opcode(state.actionPerformed))
                 state = state.prevState
+            return array("B", reversed(path))
         # Reverse the order
         return path[::-1]
 
-    def explore(self):
-        # Explores unexplroed states and returns a list of children
+    def unfold(self):
+        # returns the state reached by the plan as a chain of primitive actions
+        # the states of StateInit already are, see StatePush
+        return self
+
+    def movableBoxes(self, color):
+        # returns the box letters that agents of the given color can move
+        if self.context.movable is None:
+            movable = {}
+            for key, records in self.boxes.items():
+                for _, boxcolor in records:
+                    movable.setdefault(boxcolor, set()).add(key)
+            self.context.movable = movable
+        return self.context.movable.get(color, ())
+
+    @property
+    def steps(self):
+        # grounded steps of the level, see LevelContext.buildSteps
+        if self.context.steps is None:
+            return self.context.buildSteps()
+        return self.context.steps
+
+    @property
+    def deadCells(self):
+        # cells where a box of each letter can never reach a goal again, see
+        # LevelContext.buildDeadCells
+        if self.context.dead is None:
+            return self.context.buildDeadCells(self.boxes)
+        return self.context.dead
+
+    def __adjacentBoxes(self, agtkey, steps):
+        # returns (boxkey, i, boxfrom) of the boxes the agent can move, in the
+        # order of the box records; occupied is the cell -> box index, so only
+        # the neighbour cells of the agent are looked at
+        agtfrom, color = self.agents[agtkey][0]
+        movable = self.movableBoxes(color)
+        adjacent = []
+        for pos in steps[agtfrom]:
+            boxkey = self.occupied.get(pos)
+            if boxkey not in movable:
+                continue
+            try:
+                i = self.boxes[boxkey].index((pos, color))
+            except ValueError:
+                continue  # a box of the letter with another color
+            adjacent.append((boxkey, i, pos))
+        if len(adjacent) > 1:
+            order = list(self.boxes)
+            adjacent.sort(key=lambda box: (order.index(box[0]), box[1]))
+        return adjacent
+
+    def __applicable(self):
+        # yields the applicable (name, params) of the grounded operators, ordered
+        # by direction, agent and box; the steps of the level give every target
+        # cell, so a precondition is a lookup and a Free() test, and boxes are
+        # never moved on to a dead cell of their letter, nor at all when frozen
+        steps = self.steps
+        dead = self.deadCells
+        frozen = self.context.frozen
+        agents = [
+            (
+                agtkey,
+                records[0][0],
+                () if frozen else self.__adjacentBoxes(agtkey, steps),
+            )
+            for agtkey, records in self.agents.items()
+            if records[0][0] is not None
+        ]
+        for d in range(len(self.dir)):
+            for agtkey, agtfrom, boxes in agents:
+                agtto = steps[agtfrom][d]
+                free = agtto is not None and self.Free(agtto)
+                for boxkey, i, boxfrom in boxes:
+                    deadly = dead.get(boxkey, ())
+                    if free and agtfrom not in deadly:
+                        yield "Pull", (agtkey, boxkey, agtfrom, agtto, boxfrom, i)
+                    boxto = steps[boxfrom][d]
+                    if boxto is not None and boxto not in deadly and self.Free(boxto):
+                        yield "Push", (agtkey, boxkey, agtfrom, boxfrom, boxto, i)
+                if free:
+                    yield "Move", (agtkey, agtfrom, agtto)
+
+    def expand(self, applicable):
+        # returns the unexplored children of the given (name, params) actions
         children = []
-
-        # Loop iterales through every possible action
-        for direction in self.dir:
-            for agtkey in self.agents:
-
-                # TODO reformat these nested loops and if statements!
-
-                # This can be perhaps be optimized by only looking at boxes at the
-                # neighboring tiles of the agent
-                for boxkey in self.boxes:
-                    for i in range(len(self.boxes[boxkey])):
-
-                        boxcolor = self.boxes[boxkey][i][1]
-
-                        # [agent letter][agent number (0 since it is unique)][color]
-                        if self.agents[agtkey][0][1] == boxcolor:
-                            # Checks a pull action if it is possible it is appended to the the children
-                            actionParams = self.__PullPrec(agtkey, boxkey, direction, i)
-                            if actionParams is not None:
-                                child = StateInit(self)
-                                child.actionPerformed = ["Pull", actionParams]
-                                child.__PullEffect(*actionParams)
-                                child.__addToExplored(children)
-                            actionParams = self.__PushPrec(agtkey, boxkey, direction, i)
-                            if actionParams is not None:
-                                child = StateInit(self)
-                                child.actionPerformed = ["Push", actionParams]
-                                child.__PushEffect(*actionParams)
-                                child.__addToExplored(children)
-                            # Checks a Push action if it is possible it is appended to the the children
-                # Checks a Move action if it is possible it is appended to the the children
-                actionParams = self.__MovePrec(agtkey, direction)
-                if actionParams is not None:
-                    child = StateInit(self)
-                    child.actionPerformed = ["Move", actionParams]
-
-                    child.__MoveEffect(*actionParams)
-                    child.__addToExplored(children)
-
-        for agtkey in self.agents:
-            # TODO make a noop function
-            child = StateInit(self)
-            child.actionPerformed = ["NoOp", None]
+        for name, actionParams in applicable:
+            # a macro ends elsewhere than its first step, check it once built
+            if not self.context.macros and self.__knownChild(name, actionParams):
+                self.context.skipped += 1
+                continue
+            child = type(self)(self)
+            child.actionPerformed = [name, actionParams]
+            if actionParams is not None:
+                self.__effects[name](child, *actionParams)
+                if self.context.macros and len(self.agents) == 1:
+                    child = child.__throughTunnel(name, actionParams)
+                    child = child.__intoGoalRoom()
             child.__addToExplored(children)
-
         return children
 
+    def __knownChild(self, name, actionParams):
+        # tells if the child of an action is explored without allocating it:
+        # its hash is the parent's with the moved records swapped, and only when
+        # that hash is in the explored table are the child's records built
+        if name == "Move":
+            agt, agtfrom, agtto = actionParams
+            moves = [(self.agents, agt, 0, agtto)]
+        elif name == "Push":
+            agt, boxkey, agtfrom, boxfrom, boxto, i = actionParams
+            moves = [(self.agents, agt, 0, boxfrom), (self.boxes, boxkey, i, boxto)]
+        elif name == "Pull":
+            agt, boxkey, agtfrom, agtto, boxfrom, i = actionParams
+            moves = [(self.agents, agt, 0, agtto), (self.boxes, boxkey, i, agtfrom)]
+        else:
+            moves = []
+        key = self.hash
+        for objtype, obj, i, pos in moves:
+            prev, color = objtype[obj][i]
+            key ^= ZOBRIST[obj, color, prev] ^ ZOBRIST[obj, color, pos]
+        bucket = self.explored.get(key)
+        if bucket is None:
+            return False
+        agents, boxes = self.agents, self.boxes
+        for objtype, obj, i, pos in moves:
+            records = objtype[obj]
+            records = records[:i] + ((pos, records[i][1]),) + records[i + 1 :]
+            if objtype is self.agents:
+                agents = {**agents, obj: records}
+            else:
+                boxes = {**boxes, obj: records}
+        return any(sameRecords(agents, boxes, *entry) for entry in bucket)
+
+    def __throughTunnel(self, name, actionParams):
+        # macro action: keeps walking, pushing or pulling along a tunnel and
+        # returns the state at its end; every step is a primitive child of the
+        # previous one, so bestPath() and the trajectories see each action
+        tunnels = self.context.tunnels
+        if tunnels is None:
+            tunnels = self.context.buildTunnels()
+        state = self
+        for _ in range(len(tunnels)):
+            if name == "Move":
+                agt, agtfrom, agtto = actionParams
+                if agtto not in tunnels:
+                    break
+                ahead = [pos for pos in tunnels[agtto] if pos != agtfrom]
+                if len(ahead) != 1 or not state.Free(ahead[0]):
+                    break
+                actionParams = (agt, agtto, ahead[0])
+            elif name == "Push":
+                agt, boxkey, agtfrom, boxfrom, boxto, i = actionParams
+                if boxto not in tunnels:
+                    break
+                ahead = [pos for pos in tunnels[boxto] if pos != boxfrom]
+                if len(ahead) != 1 or not state.Free(ahead[0]):
+                    break
+                actionParams = (agt, boxkey, boxfrom, boxto, ahead[0], i)
+            else:
+                agt, boxkey, agtfrom, agtto, boxfrom, i = actionParams
+                # the box must follow into the tunnel, a box pulled out to
+                # the mouth may still be pushed off to the side
+                if agtto not in tunnels or agtfrom not in tunnels:
+                    break
+                ahead = [pos for pos in tunnels[agtto] if pos != agtfrom]
+                if len(ahead) != 1 or not state.Free(ahead[0]):
+                    break
+                actionParams = (agt, boxkey, agtto, ahead[0], agtfrom, i)
+            child = type(state)(state)
+            child.actionPerformed = [name, actionParams]
+            self.__effects[name](child, *actionParams)
+            state = child
+        return state
+
+    def __intoGoalRoom(self):
+        # macro action: a box just moved into a goal room from its entrance is
+        # taken to the next goal of the room's fill order, see buildGoalRooms;
+        # the walks, pushes and pulls are found by a breadth first search in
+        # the room and every step is a primitive child, as in __throughTunnel
+        rooms = self.context.rooms
+        if rooms is None:
+            rooms = self.context.buildGoalRooms()
+        name, actionParams = self.actionPerformed
+        if name == "Push":
+            agt, boxkey, _, boxfrom, boxto, i = actionParams
+        elif name == "Pull":
+            agt, boxkey, boxto, _, boxfrom, i = actionParams
+        else:
+            return self
+        room = rooms.get(boxto)
+        if room is None or boxfrom in room[1]:
+            return self
+        entrance, cells, order = room
+        agtpos = self.agents[agt][0][0]
+        # the goals before the target hold their boxes, the rest is empty
+        filled = set()
+        for target, letter in order:
+            if target == boxto or self.occupied.get(target) != letter:
+                break
+            filled.add(target)
+        else:
+            return self
+        if letter != boxkey:
+            return self
+        for cell in cells - filled:
+            if cell not in (agtpos, boxto) and not self.Free(cell):
+                return self
+        free = set(cells - filled)
+        free.add(agtpos)
+        if self.Free(entrance):
+            free.add(entrance)
+        # breadth first search on (agent cell, box cell)
+        steps = self.context.steps
+        parents = {(agtpos, boxto): None}
+        frontier = [(agtpos, boxto)]
+        for agtfrom, boxfrom in frontier:
+            if boxfrom == target:
+                break
+            for d in range(len(self.dir)):
+                agtto = steps[agtfrom][d]
+                if agtto == boxfrom:
+                    ahead = steps[boxfrom][d]
+                    if ahead in cells and ahead in free:
+                        action = "Push", (agt, boxkey, agtfrom, boxfrom, ahead, i)
+                        moves = [((boxfrom, ahead), action)]
+                    else:
+                        moves = []
+                elif agtto in free:
+                    moves = [((agtto, boxfrom), ("Move", (agt, agtfrom, agtto)))]
+                    if boxfrom in steps[agtfrom] and agtfrom in cells:
+                        action = "Pull", (agt, boxkey, agtfrom, agtto, boxfrom, i)
+                        moves.append(((agtto, agtfrom), action))
+                else:
+                    moves = []
+                for node, action in moves:
+                    if node not in parents:
+                        parents[node] = (agtfrom, boxfrom), action
+                        frontier.append(node)
+        else:
+            return self
+        path = []
+        node = agtfrom, boxfrom
+        while parents[node] is not None:
+            node, action = parents[node]
+            path.append(action)
+        state = self
+        for name, actionParams in reversed(path):
+            child = type(state)(state)
+            child.actionPerformed = [name, actionParams]
+            self.__effects[name](child, *actionParams)
+            state = child
+        return state
+
+    def explore(self):
+        # Explores unexplroed states and returns a list of children
+        # TODO make a noop function
+        noops = [("NoOp", None)] * len(self.agents)
+        return self.expand(itertools.chain(self.__applicable(), noops))
+
+    # effects of the grounded operators, by name
+    __effects = {"Move": __MoveEffect, "Push": __PushEffect, "Pull": __PullEffect}
+
 
 class StateConcurrent(StateInit):
     """Extend StateInit with concurrent literals."""
 
+    __slots__ = ("concurrent", "ghosts")
+
     def __init__(self, parent: StateInit = None, concurrent: Dict = None):
         """Initialize by adding a time table to the usual `StateInit`.
 
@@ -486,15 +1307,50 @@ class StateConcurrent(StateInit):
         ----------
         parent: StateInit
         concurrent: Dict
-            Shared table that contains times where an object (box) in the
+            Table that contains times where an object (box) in the
             environment has been changed by another agent:
                 {t: {box: [(row, col), index], ...}, ...}
+            It is turned into a `Timeline` shared by the descendants; if it
+            is not given, the parent's timeline is used.
 
         """
         super().__init__(parent)
-        self.concurrent = concurrent if concurrent else parent.concurrent
+        if concurrent is None:
+            self.concurrent = parent.concurrent
+        elif isinstance(concurrent, Timeline):
+            self.concurrent = concurrent
+        else:
+            self.concurrent = Timeline(concurrent)
         self.hunt_ghost()
 
+    @property
+    def map(self):
+        """Render the map with the ghosts left by concurrent changes."""
+        map = super().map
+        for pos in self.ghosts:
+            map[pos] = "Ñ"
+        return map
+
+    def sameAs(self, agents, boxes):
+        """Compare records in order.
+
+        The concurrent table addresses boxes by index, so boxes with the
+        same letter and color are not interchangeable here.
+        """
+        return agents == self.agents and boxes == self.boxes
+
+    def deadlocked(self):
+        """Never frozen: other agents move boxes through the timeline."""
+        return frozenset()
+
+    def Free(self, pos):
+        """Check if position is free, ghosted positions are not."""
+        if pos in self.ghosts or pos in self.occupied:
+            return False
+        if self.context.layout[pos] == WALL:
+            return False
+        return True
+
     def __NoOpPrec(self):
         """Evaluate precondition for NoOp.
 
@@ -503,16 +1359,9 @@ class StateConcurrent(StateInit):
         return self.__WaitPrec_t(self.t) and self.__WaitPrec_t(self.t+1)
 
     def __WaitPrec_t(self, t):
-        if t in self.concurrent:
-            joint_concurrent = self.concurrent[t]
-            # a state that it is being solved is guaranteed to have only one agent
-            agent_pos = self.getPos(self.agents, list(self.agents.keys())[0])
-            for pos, _ in joint_concurrent.values():
-                if pos is None:
-                    continue
-                if agent_pos[0] == pos[0] and agent_pos[1] == pos[1]:
-                    return False
-        return True
+        # a state that it is being solved is guaranteed to have only one agent
+        agent_pos = next(iter(self.agents.values()))[0][0]
+        return not self.concurrent.isTaken(t, agent_pos)
 
     def __ConcurrentPrec(self):
         """Evaluate precondition for concurrent changes of the world.
@@ -523,26 +1372,53 @@ class StateConcurrent(StateInit):
 
     def __ConcurrentEffect(self, t):
         """Modify environment according to concurrent actions at time `t`."""
-        joint_concurrent = self.concurrent[t]
-        for obj_key in joint_concurrent:
-            pos, index = list(joint_concurrent[obj_key])
-            obj_group = "agents" if obj_key.isnumeric() else "boxes"
-            if obj_group == "boxes":
-                prev_pos = self.getPos(getattr(self, obj_group), obj_key, index)
-                self.setPos(getattr(self, obj_group), obj_key, pos, index)
-                # introduce a ghost box which will be removed on child nodes
-                self.map[prev_pos[0], prev_pos[1]] = "Ñ"
-                if pos is not None:
-                    self.map[pos[0], pos[1]] = obj_key
+        ghosts = set(self.ghosts)
+        for obj_key, pos, index, prev_pos in self.concurrent.events[t]:
+            if obj_key.isnumeric():
+                # agents are not in the StateInit, the timeline knows where
+                # they were; they don't leave ghosts behind
+                if prev_pos is not None and self.occupied.get(prev_pos) == obj_key:
+                    del self.occupied[prev_pos]
+                    ghosts.add(prev_pos)
             else:
-                # agents don't leave ghosts behind and are not in the StateInit
-                self.map[self.map == obj_key] = "Ñ"
-                self.map[pos[0], pos[1]] = obj_key
+                prev_pos = self.getPos(self.boxes, obj_key, index)
+                self.setPos(self.boxes, obj_key, pos, index)
+                # introduce a ghost box which will be removed on child nodes
+                if prev_pos is not None:
+                    self.occupied.pop(prev_pos, None)
+                    ghosts.add(prev_pos)
+            if pos is not None:
+                self.occupied[pos] = obj_key
+        self.ghosts = frozenset(ghosts)
+        if self.context.sipp:
+            # the same records in another epoch of the world are a new state
+            epoch = self.concurrent.epoch(t)
+            self.hash ^= ZOBRIST["~", None, epoch - 1] ^ ZOBRIST["~", None, epoch]
         return True
 
+    def __wait(self):
+        """Wait in place until the next change of the world.
+
+        The wait is a single child whose time jumps to the change, None if
+        another object enters the cell of the agent before the change or
+        right after it.
+        """
+        next_time = self.concurrent.after(self.t)
+        if next_time is None:
+            return None
+        agent_pos = next(iter(self.agents.values()))[0][0]
+        if self.concurrent.safeUntil(self.t, agent_pos) <= next_time:
+            return None
+        child = StateConcurrent(self)
+        child.g += next_time - child.t
+        child.t = next_time
+        child.actionPerformed = ["NoOp", None]
+        child.__ConcurrentEffect(next_time)
+        return child
+
     def hunt_ghost(self):
         """Remove ghosted positions put by a Councurent Effect."""
-        self.map[self.map == "Ñ"] = " "
+        self.ghosts = frozenset()
 
     def explore(self):
         """Explore with 'NoOp's.
@@ -551,63 +1427,35 @@ class StateConcurrent(StateInit):
         by another agent; i.e., there is an entry in `self.concurrent`
         for the next time `self.t`. This ensures that agents just wait if the
         next state is new and applies the concurrent changes to all children.
+
+        With `context.sipp`, the NoOp is instead a wait of any duration
+        until the next change, as long as the cell of the agent is safe.
         """
         children = []
 
         # Loop iterales through every possible action
         child_def = StateConcurrent(self)
 
+        if self.context.sipp:
+            child = self.__wait()
+            if child is not None:
+                child._StateInit__addToExplored(children)
+
         if child_def.__ConcurrentPrec():
             # apply concurrent effects to all children but also append
             # a NoOp children which just waits for the env to change
             # println("Applying NoOp")
             child_def.__ConcurrentEffect(child_def.t)
-            if child_def.__NoOpPrec():
-                child = copy.deepcopy(child_def)
+            if not self.context.sipp and child_def.__NoOpPrec():
+                child = child_def.clone()
                 child.actionPerformed = ["NoOp", None]
                 child._StateInit__addToExplored(children)
 
-        for direction in self.dir:
-            for agtkey in self.agents:
-
-                # TODO reformat these nested loops and if statements!
-
-                # This can be perhaps be optimized by only looking at boxes at
-                # the neighboring tiles of the agent
-
-                for boxkey in child_def.boxes:
-                    for i in range(len(child_def.boxes[boxkey])):
-
-                        boxcolor = child_def.boxes[boxkey][i][1]
-
-                        # [agent letter][agent number (0 since it is unique)][color]
-                        if child_def.agents[agtkey][0][1] == boxcolor:
-                            # Checks a pull action if it is possible it is appended to the the children
-                            actionParams = child_def._StateInit__PullPrec(
-                                agtkey, boxkey, direction, i
-                            )
-                            if actionParams is not None:
-                                child = copy.deepcopy(child_def)
-                                child.actionPerformed = ["Pull", actionParams]
-                                child._StateInit__PullEffect(*actionParams)
-                                child._StateInit__addToExplored(children)
-                            # Checks a Push action if it is possible it is appended to the the children
-                            actionParams = child_def._StateInit__PushPrec(
-                                agtkey, boxkey, direction, i
-                            )
-                            if actionParams is not None:
-                                child = copy.deepcopy(child_def)
-                                child.actionPerformed = ["Push", actionParams]
-                                child._StateInit__PushEffect(*actionParams)
-                                child._StateInit__addToExplored(children)
-                # Checks a Move action if it is possible it is appended to the the children
-                actionParams = child_def._StateInit__MovePrec(agtkey, direction)
-                if actionParams is not None:
-                    child = copy.deepcopy(child_def)
-                    child.actionPerformed = ["Move", actionParams]
-
-                    child._StateInit__MoveEffect(*actionParams)
-                    child._StateInit__addToExplored(children)
+        for name, actionParams in child_def._StateInit__applicable():
+            child = child_def.clone()
+            child.actionPerformed = [name, actionParams]
+            self._StateInit__effects[name](child, *actionParams)
+            child._StateInit__addToExplored(children)
 
         return children
 
@@ -616,19 +1464,467 @@ class StateConcurrent(StateInit):
 
         It will be called by by strategy.
         """
-        future = [t for t in self.concurrent if t > self.t]
-        if future:
-            return min(future)
-        return False
+        next_time = self.concurrent.after(self.t)
+        return next_time if next_time is not None else False
 
     def advance(self) -> StateInit:
         """Advance in time until the environment is changed by other agent."""
         next_time = self.AdvancePrec()
         if not next_time:
             return self
+        if self.context.sipp:
+            # a single wait, unfold() spells it out as NoOps
+            future_self = StateConcurrent(self)
+            future_self.g += next_time - future_self.t
+            future_self.t = next_time
+            future_self.actionPerformed = ["NoOp", None]
+            return future_self
         future_self = self
         while next_time > future_self.t:
-            println(future_self)
             future_self = StateConcurrent(future_self)
             future_self.actionPerformed = ["NoOp", None]
+        println(f"Waited {next_time - self.t} steps until t = {next_time}")
         return future_self
+
+    def unfold(self):
+        """Turn the waits leading to the state into one NoOp per time step."""
+        state = self
+        while state.actionPerformed is not None:
+            parent = state.prevState
+            if state.t - parent.t > 1:
+                # in between, the parent just stands still
+                step = parent
+                for _ in range(state.t - parent.t - 1):
+                    step = StateConcurrent(step)
+                    step.actionPerformed = ["NoOp", None]
+                state.prevState = step
+            state = parent
+        self.trajectories = None
+        return self
+
+
+class StateBitboard(StateInit):
+    """StateInit that answers occupancy and goal queries with bitboards.
+
+    Besides the usual records, every node packs the cells of its agents,
+    of all its boxes and of the boxes of each letter into Python ints. The
+    walls and the goals of each letter are packed once per level in the
+    `Bitboards` of the shared LevelContext, so `Free()` and
+    `isGoalState()` are a few bitwise operations.
+    """
+
+    __slots__ = ("agentBoard", "boxBoard", "letterBoards")
+
+    def __init__(self, parent: StateInit = None):
+        """Initialize, packing the parent's objects if it is not a bitboard."""
+        super().__init__(parent)
+        if isinstance(parent, StateBitboard):
+            self.agentBoard = parent.agentBoard
+            self.boxBoard = parent.boxBoard
+            self.letterBoards = parent.letterBoards.copy()
+        elif parent is not None:
+            self.packBoards()
+        else:
+            self.agentBoard = 0
+            self.boxBoard = 0
+            self.letterBoards = {}
+
+    def packBoards(self):
+        """Pack the bitboards of the node from its agent and box records."""
+        boards = self.bitboards
+        self.agentBoard = boards.pack(
+            records[0][0] for records in self.agents.values()
+        )
+        self.letterBoards = {
+            key: boards.pack(pos for pos, _ in records)
+            for key, records in self.boxes.items()
+        }
+        self.boxBoard = 0
+        for board in self.letterBoards.values():
+            self.boxBoard |= board
+
+    @property
+    def bitboards(self) -> Bitboards:
+        """Rigid bitboards of the level, rebuilt after the level changes."""
+        if self.context.bitboards is None:
+            self.context.bitboards = Bitboards(self.context)
+        return self.context.bitboards
+
+    def addAgent(self, key, pos, color="c"):
+        """Add an agent to the records and to the agent bitboard."""
+        super().addAgent(key, pos, color)
+        self.agentBoard |= self.bitboards.bit(pos)
+
+    def addBox(self, key, pos, color="c"):
+        """Add a box to the records and to the box bitboards."""
+        super().addBox(key, pos, color)
+        bit = self.bitboards.bit(pos)
+        key = key.upper()
+        self.letterBoards[key] = self.letterBoards.get(key, 0) | bit
+        self.boxBoard |= bit
+
+    def deleteAgent(self, external_key):
+        """Delete an agent from the records and the agent bitboard."""
+        pos = self.getPos(self.agents, external_key)
+        super().deleteAgent(external_key)
+        self.agentBoard &= ~self.bitboards.bit(pos)
+
+    def deleteBox(self, external_key):
+        """Delete the boxes of a letter from the records and the bitboards."""
+        super().deleteBox(external_key)
+        self.boxBoard &= ~self.letterBoards.pop(external_key, 0)
+
+    def setPos(self, objtype, obj, pos, i=0):
+        """Set the position of an object and move its bit."""
+        prev = objtype[obj][i][0]
+        if type(prev) != tuple:
+            return None
+        super().setPos(objtype, obj, pos, i)
+        moved = self.bitboards.bit(prev) | self.bitboards.bit(pos)
+        if objtype is self.agents:
+            self.agentBoard ^= moved
+        else:
+            self.letterBoards[obj] ^= moved
+            self.boxBoard ^= moved
+
+    def Free(self, pos):
+        """Check if position is free with the wall, agent and box bitboards."""
+        boards = self.bitboards
+        return not boards.bit(pos) & (boards.walls | self.agentBoard | self.boxBoard)
+
+    def isGoalState(self):
+        """Check that every goal cell is covered by a box of its letter."""
+        for key, goals in self.bitboards.goals.items():
+            if goals & ~self.letterBoards.get(key, 0):
+                return False
+        return True
+
+
+class StateDelta(StateInit):
+    """StateInit whose occupancy is delta-encoded against the parent.
+
+    The agent and box records are already shared with the parent, so the
+    dynamic layer of the map is the only part of a node that is copied in
+    full; here it is an `Occupancy` holding the few cells an action
+    touched, with a full snapshot every `Occupancy.snapshotEvery` levels.
+    It trades a few dict lookups per `Free()` for memory on deep searches.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, parent: StateInit = None):
+        """Initialize, wrapping the occupancy of a root or a plain parent."""
+        super().__init__(parent)
+        if not isinstance(self.occupied, Occupancy):
+            self.occupied = Occupancy(self.occupied)
+
+
+class StatePush(StateInit):
+    """StateInit searched at the level of box moves.
+
+    A node is a box configuration plus the region each agent can walk to,
+    two nodes whose agents reach the same regions are the same node: the
+    agents are hashed and compared by the smallest cell of their region.
+    The successors are the pushes and pulls an agent reaches by walking,
+    found with a flood fill, and g and t count the walk. The walks only
+    become Move actions in `unfold()`, once a plan is found.
+    """
+
+    __slots__ = ("canonical",)
+
+    def __init__(self, parent: StateInit = None):
+        """Initialize, hashing the agents at their own cell again."""
+        super().__init__(parent)
+        if isinstance(parent, StatePush) and parent.canonical is not None:
+            for key, ((pos, color),) in parent.agents.items():
+                canonical = parent.canonical[key][0][0]
+                self.hash ^= ZOBRIST[key, color, canonical] ^ ZOBRIST[key, color, pos]
+        self.canonical = None
+
+    def reach(self, agtkey) -> Dict:
+        """Flood fill the free cells around an agent.
+
+        Returns
+        -------
+        Dict
+            cell -> (walking distance, previous cell), in breadth first order
+
+        """
+        start = self.agents[agtkey][0][0]
+        steps = self.steps
+        reached = {start: (0, None)}
+        frontier = [start]
+        for cell in frontier:
+            dist = reached[cell][0] + 1
+            for pos in steps[cell]:
+                if pos is not None and pos not in reached and self.Free(pos):
+                    reached[pos] = (dist, cell)
+                    frontier.append(pos)
+        return reached
+
+    def regions(self) -> Dict:
+        """Return the agents at the smallest cell of the region they reach."""
+        return {
+            key: ((min(self.reach(key)) if pos is not None else pos, color),)
+            for key, ((pos, color),) in self.agents.items()
+        }
+
+    def normalize(self):
+        """Hash the agents at the smallest cell of the region they reach."""
+        self.canonical = self.regions()
+        for key, ((pos, color),) in self.agents.items():
+            canonical = self.canonical[key][0][0]
+            self.hash ^= ZOBRIST[key, color, pos] ^ ZOBRIST[key, color, canonical]
+
+    def records(self):
+        """Keep the agents at their canonical cell in the explored table."""
+        return self.canonical, self.boxes
+
+    def sameAs(self, agents, boxes):
+        """Compare the regions of the agents and the boxes."""
+        return agents == self.canonical and super().sameAs(self.agents, boxes)
+
+    def explore(self):
+        """Return the unexplored pushes and pulls the agents can walk to.
+
+        A single agent only moves the boxes of a corral when there is one,
+        see `corral()`. The regions go into `walked`, so an agent whose
+        search fails still finds the boxes next to where it walked.
+        """
+        children = []
+        for agtkey, ((agtpos, color),) in self.agents.items():
+            if agtpos is None:
+                continue
+            reached = self.reach(agtkey)
+            # the explored table only keeps the smallest cell of the region
+            self.walked.setdefault(agtkey, set()).update(reached)
+            moves = list(self.boxMoves(agtkey, color, reached))
+            if len(self.agents) == 1:
+                corral = self.corral(color, reached, moves)
+                if corral:
+                    moves = [move for move in moves if self.boxCell(move) in corral]
+            for name, actionParams, dist in moves:
+                self.__boxMove(children, name, actionParams, agtpos, dist)
+        return children
+
+    def boxMoves(self, agtkey, color, reached):
+        """Yield the (name, params, walk) of the box moves of an agent.
+
+        The walk is the distance to the cell the agent moves the box from.
+        """
+        steps = self.steps
+        agtpos = self.agents[agtkey][0][0]
+        movable = self.movableBoxes(color)
+        dead = self.deadCells
+
+        def free(pos):
+            # the agent walks away from its own cell
+            return pos is not None and (pos == agtpos or self.Free(pos))
+
+        for cell, (dist, _) in reached.items():
+            for boxfrom in steps[cell]:
+                boxkey = self.occupied.get(boxfrom)
+                if boxkey not in movable:
+                    continue
+                try:
+                    i = self.boxes[boxkey].index((boxfrom, color))
+                except ValueError:
+                    continue  # a box of the letter with another color
+                # the agent takes the cell of the box, which goes either way
+                deadly = dead.get(boxkey, ())
+                for boxto in steps[boxfrom]:
+                    if boxto != cell and boxto not in deadly and free(boxto):
+                        params = (agtkey, boxkey, cell, boxfrom, boxto, i)
+                        yield "Push", params, dist
+                for agtto in steps[cell]:
+                    if agtto != boxfrom and cell not in deadly and free(agtto):
+                        params = (agtkey, boxkey, cell, agtto, boxfrom, i)
+                        yield "Pull", params, dist
+
+    @staticmethod
+    def boxCell(move):
+        """Return the cell of the box a (name, params, walk) move moves."""
+        name, actionParams, _ = move
+        return actionParams[3] if name == "Push" else actionParams[4]
+
+    def corral(self, color, reached, moves) -> set:
+        """Return the boxes of the corral with the fewest moves, if any.
+
+        A corral is a region of free cells the agent cannot reach, closed by
+        walls, boxes it cannot move and the boxes around it. It counts when
+        it holds a goal or one of its boxes is off the goals of a letter
+        whose boxes all have to reach one, and when the agent can push every
+        box around it, and only into it. The corral has to be opened sooner
+        or later, so the moves of its boxes come first.
+        """
+        steps = self.steps
+        movable = self.movableBoxes(color)
+        needed = self.deadCells
+        cells = self.context.goalCells
+        if cells is None:
+            cells = self.context.buildGoalCells()
+        pushes = {}
+        for name, actionParams, _ in moves:
+            if name == "Push":
+                pushes.setdefault(actionParams[3], []).append(actionParams[4])
+        best, fewest = None, None
+        seen = set(reached)
+        for start in steps:
+            if start in seen or not self.Free(start):
+                continue
+            region = {start}
+            boxes = set()
+            frontier = [start]
+            for cell in frontier:
+                for pos in steps[cell]:
+                    if pos is None or pos in region:
+                        continue
+                    key = self.occupied.get(pos)
+                    if key is None:
+                        region.add(pos)
+                        frontier.append(pos)
+                    elif key in movable:
+                        boxes.add(pos)
+            seen |= region
+            count = 0
+            for pos in boxes:
+                if not pushes.get(pos) or not region.issuperset(pushes[pos]):
+                    break
+                count += len(pushes[pos])
+            else:
+                if fewest is not None and count >= fewest:
+                    continue
+                if any(cell in cells for cell in region) or any(
+                    self.occupied[pos] in needed
+                    and cells.get(pos, ("",))[0] != self.occupied[pos]
+                    for pos in boxes
+                ):
+                    best, fewest = boxes, count
+        return best
+
+    def __boxMove(self, children, name, actionParams, agtpos, dist):
+        # walks the agent to the box, moves the box and keeps the child if new
+        child = StatePush(self)
+        child.actionPerformed = [name, actionParams]
+        agtkey, cell = actionParams[0], actionParams[2]
+        if dist:
+            child._StateInit__MoveEffect(agtkey, agtpos, cell)
+            child.g += dist
+            child.t += dist
+        StateInit._StateInit__effects[name](child, *actionParams)
+        child.normalize()
+        child._StateInit__addToExplored(children)
+
+    def unfold(self) -> StateInit:
+        """Return the plan as a chain of StateInit with the walks as Moves."""
+        chain = []
+        state = self
+        while state.actionPerformed is not None:
+            chain.append(state)
+            state = state.prevState
+        for node in reversed(chain):
+            name, actionParams = node.actionPerformed
+            agtkey, cell = actionParams[0], actionParams[2]
+            reached = StatePush.reach(state, agtkey)
+            walk = []
+            while reached[cell][1] is not None:
+                walk.append(cell)
+                cell = reached[cell][1]
+            for agtto in reversed(walk):
+                child = StateInit(state)
+                agtfrom = child.agents[agtkey][0][0]
+                child.actionPerformed = ["Move", (agtkey, agtfrom, agtto)]
+                child._StateInit__MoveEffect(agtkey, agtfrom, agtto)
+                state = child
+            child = StateInit(state)
+            child.actionPerformed = [name, actionParams]
+            StateInit._StateInit__effects[name](child, *actionParams)
+            state = child
+        return state
+
+
+class StateJoint(StateInit):
+    """StateInit of a group of agents searched jointly by operator decomposition.
+
+    The agents of `order` take their turn one after the other, so a node
+    branches on the actions of a single agent. The action of the first
+    agent opens a joint step and counts it in g and t, the nodes of the
+    other turns keep that g and t, so every action of the step happens at
+    its time. The node where the last agent has acted closes the step:
+    only those nodes go into the explored table and can be goals.
+    `touched` holds the cells the agents already involved in the current
+    step; no other agent may use them, which mirrors the server checking
+    every action against the state at the start of the joint action.
+    """
+
+    __slots__ = ("order", "turn", "touched")
+
+    def __init__(self, parent: StateInit = None, order=None):
+        """Initialize, the agents of `order` act in that order."""
+        super().__init__(parent)
+        if isinstance(parent, StateJoint):
+            self.order = parent.order
+            self.turn = parent.turn
+            self.touched = parent.touched
+            if parent.turn != 0:
+                # the joint step of the parent goes on, it was counted when
+                # the first agent acted
+                self.g, self.t = parent.g, parent.t
+        else:
+            self.order = tuple(sorted(self.agents)) if order is None else order
+            self.turn = 0
+            self.touched = frozenset()
+
+    @staticmethod
+    def cells(name, actionParams) -> frozenset:
+        """Return the cells an action takes part in."""
+        if name == "Move":
+            return frozenset(actionParams[1:])
+        if name in ("Push", "Pull"):
+            return frozenset(actionParams[2:5])
+        return frozenset()
+
+    def isGoalState(self):
+        """Check the goals at the end of a joint step only."""
+        return self.turn == 0 and super().isGoalState()
+
+    def explore(self):
+        """Return the children of the actions of the agent whose turn it is."""
+        actor = self.order[self.turn]
+        turn = (self.turn + 1) % len(self.order)
+        actions = itertools.chain(
+            [("NoOp", None)],
+            (
+                (name, actionParams)
+                for name, actionParams in self._StateInit__applicable()
+                if actionParams[0] == actor
+            ),
+        )
+        children = []
+        for name, actionParams in actions:
+            cells = self.cells(name, actionParams)
+            if not self.touched.isdisjoint(cells):
+                continue
+            child = StateJoint(self)
+            child.actionPerformed = [name, actionParams]
+            if actionParams is not None:
+                StateInit._StateInit__effects[name](child, *actionParams)
+            child.turn = turn
+            if turn == 0:
+                child.touched = frozenset()
+                child._StateInit__addToExplored(children)
+            else:
+                # nodes inside a joint step are not states of the world
+                child.touched = self.touched | cells
+                children.append(child)
+        return children
+
+    def jointPaths(self) -> Dict:
+        """Split the plan into the opcodes of every agent of the group."""
+        paths = {agent: [] for agent in self.order}
+        state = self
+        while state.actionPerformed is not None:
+            parent = state.prevState
+            paths[parent.order[parent.turn]].append(opcode(state.actionPerformed))
+            state = parent
+        return {agent: array("B", reversed(path)) for agent, path in paths.items()}
@@ -0,0 +1,229 @@
+"""Array-backed storage of search nodes for the best-first strategies."""
+import heapq
+from typing import List, Tuple
+
+import numpy as np
+
+from multi_sokoban.actions import (
+    ACTIONS,
+    NOOP,
+    Occupancy,
+    StateBitboard,
+    StateConcurrent,
+    StateDelta,
+    StateInit,
+    StateJoint,
+    StatePush,
+    opcode,
+)
+
+
+class NodeArena:
+    """Frontier of search nodes packed into preallocated arrays.
+
+    It is a drop-in replacement of the `PriorityQueue` used as frontier by
+    the strategies. A node is an integer id into struct-of-arrays storage
+    holding the packed positions (one cell index per agent and box), the
+    parent id, g, t, h, f, the zobrist hash, the opcode and the index
+    of the node's records in the explored table; the heap only holds
+    `(f, id)`. A node is turned back into a state when it is
+    popped. Popped states are kept since they are the parents of the nodes
+    that are still packed, so `bestPath()` works as usual.
+
+    Attributes
+    ----------
+    slots: List[Tuple]
+        (group, key, index) of the object stored in each column of `positions`
+    expanded: List[StateInit]
+        popped states, `parent` holds indices into this list
+    extras: Dict
+        arena id -> what the arrays do not hold: (occupied, ghosts) of
+        `StateConcurrent` nodes, whose occupancy also holds objects of other
+        agents, and (turn, touched) of `StateJoint` nodes
+
+    """
+
+    def __init__(self, root: StateInit, capacity: int = 4096):
+        """Lay out the arrays after the agents and boxes of `root`."""
+        self.cols = root.layout.shape[1]
+        self.slots = [("agents", key, 0) for key in root.agents] + [
+            ("boxes", key, i)
+            for key, records in root.boxes.items()
+            for i in range(len(records))
+        ]
+        self.slot_of = {(key, i): n for n, (_, key, i) in enumerate(self.slots)}
+        self.colors = [getattr(root, group)[key][i][1] for group, key, i in self.slots]
+        self.size = 0
+        self.capacity = 0
+        self._grow(capacity)
+        self.heap = []
+        self.expanded = []
+        self.extras = {}
+        self._register(root)
+
+    def _grow(self, capacity: int):
+        """Reallocate the arrays to hold `capacity` nodes."""
+        fields = {
+            "positions": (np.int32, (capacity, len(self.slots))),
+            "parent": (np.int32, capacity),
+            "g": (np.int32, capacity),
+            "t": (np.int32, capacity),
+            "h": (np.float64, capacity),
+            "f": (np.float64, capacity),
+            "hash": (np.uint64, capacity),
+            "action": (np.uint8, capacity),
+            "agent": (np.int16, capacity),
+            "box": (np.int16, capacity),
+            "record": (np.int16, capacity),
+        }
+        for name, (dtype, shape) in fields.items():
+            array = np.empty(shape, dtype=dtype)
+            if self.capacity:
+                array[: self.size] = getattr(self, name)[: self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def _pack(self, state: StateInit) -> int:
+        """Store `state` in a new row and return its id."""
+        if self.size == self.capacity:
+            self._grow(2 * self.capacity)
+        node = self.size
+        self.size += 1
+        row = self.positions[node]
+        for n, (group, key, i) in enumerate(self.slots):
+            # a replanning state may lack objects of the root, packed as removed
+            records = getattr(state, group).get(key, ())
+            pos = records[i][0] if i < len(records) else None
+            row[n] = -1 if pos is None else pos[0] * self.cols + pos[1]
+        self.g[node] = state.g
+        self.t[node] = state.t
+        self.h[node] = state.h if state.h is not None else np.nan
+        self.f[node] = state.f if state.f is not None else np.nan
+        self.hash[node] = state.hash
+        self.action[node], self.agent[node], self.box[node] = self._encode(state)
+        self.record[node] = -1
+        for k, (agents, _) in enumerate(state.explored.get(state.hash, ())):
+            if agents is state.agents:
+                self.record[node] = k
+        if isinstance(state, StateConcurrent):
+            self.extras[node] = (state.occupied, state.ghosts)
+        elif isinstance(state, StateJoint):
+            self.extras[node] = (state.turn, state.touched)
+        return node
+
+    def _register(self, state: StateInit):
+        """Keep a parent that was not popped from the arena, e.g. the root."""
+        self.expanded.append(state)
+
+    def _encode(self, state: StateInit) -> Tuple[int, int, int]:
+        """Return the opcode, agent slot and box slot of `state`."""
+        if state.actionPerformed is None:
+            return NOOP, -1, -1
+        kind, params = state.actionPerformed
+        if kind == "Move":
+            box = -1
+        elif kind in ("Push", "Pull"):
+            box = self.slot_of[params[1], params[-1]]
+        else:
+            return NOOP, -1, -1
+        return opcode(state.actionPerformed), self.slot_of[params[0], 0], box
+
+    def _decode(self, node: int, positions: list) -> list:
+        """Rebuild `actionPerformed` of `node` from its opcode and positions."""
+        kind, d1, d2 = ACTIONS[self.action[node]]
+        if kind == "NoOp":
+            return ["NoOp", None]
+        agt = self.slots[self.agent[node]][1]
+        agtpos = positions[self.agent[node]]
+        if kind == "Move":
+            agtfrom = (agtpos[0] - d1[0], agtpos[1] - d1[1])
+            return ["Move", (agt, agtfrom, agtpos)]
+        _, boxkey, i = self.slots[self.box[node]]
+        if kind == "Push":
+            boxto = positions[self.box[node]]
+            boxfrom = (boxto[0] - d2[0], boxto[1] - d2[1])
+            agtfrom = (boxfrom[0] - d1[0], boxfrom[1] - d1[1])
+            return ["Push", (agt, boxkey, agtfrom, boxfrom, boxto, i)]
+        agtfrom = (agtpos[0] - d1[0], agtpos[1] - d1[1])
+        boxfrom = (agtfrom[0] + d2[0], agtfrom[1] + d2[1])
+        return ["Pull", (agt, boxkey, agtfrom, agtpos, boxfrom, i)]
+
+    def _materialize(self, node: int) -> StateInit:
+        """Turn the row `node` back into a state."""
+        parent = self.expanded[self.parent[node]]
+        positions = [
+            None if cell < 0 else divmod(int(cell), self.cols)
+            for cell in self.positions[node]
+        ]
+        state = object.__new__(type(parent))
+        state.context = parent.context
+        bucket = state.explored.get(int(self.hash[node]), ())
+        if 0 <= self.record[node] < len(bucket):
+            # the explored table already holds the records of the node
+            state.agents, state.boxes = bucket[self.record[node]]
+        else:
+            records = {"agents": {}, "boxes": {}}
+            for n, (group, key, i) in enumerate(self.slots):
+                # actions never add objects: keep the ones of the parent
+                if i >= len(getattr(parent, group).get(key, ())):
+                    continue
+                objects = records[group]
+                record = (positions[n], self.colors[n])
+                objects[key] = objects.get(key, ()) + (record,)
+            state.agents = records["agents"]
+            state.boxes = records["boxes"]
+        if isinstance(state, StateConcurrent):
+            state.concurrent = parent.concurrent
+            state.occupied, state.ghosts = self.extras.pop(node)
+        else:
+            state.occupied = {
+                pos: key
+                for pos, (_, key, _) in zip(positions, self.slots)
+                if pos is not None
+            }
+            if isinstance(state, StateDelta):
+                state.occupied = Occupancy(state.occupied)
+        if isinstance(state, StatePush):
+            # the hash already is the one of the regions
+            state.canonical = state.regions()
+        elif isinstance(state, StateJoint):
+            state.order = parent.order
+            state.turn, state.touched = self.extras.pop(node)
+        state.hash = int(self.hash[node])
+        state.prevState = parent
+        state.actionPerformed = self._decode(node, positions)
+        state.g = int(self.g[node])
+        state.t = int(self.t[node])
+        state.h = None if np.isnan(self.h[node]) else self.h[node].item()
+        state.f = None if np.isnan(self.f[node]) else self.f[node].item()
+        state.trajectories = None
+        # the goal tally is recounted on demand
+        state.goalCells = state.unsatisfied = state.goalsMet = None
+        if isinstance(state, StateBitboard):
+            state.packBoards()
+        return state
+
+    def put(self, item: Tuple):
+        """Pack the state of a `(priority, count, state)` item."""
+        priority, _, state = item
+        # children usually come from the last popped state
+        if state.prevState is not self.expanded[-1]:
+            self._register(state.prevState)
+        node = self._pack(state)
+        self.parent[node] = len(self.expanded) - 1
+        heapq.heappush(self.heap, (priority, node))
+
+    def get(self) -> Tuple:
+        """Pop the best node as a `(priority, id, state)` item."""
+        priority, node = heapq.heappop(self.heap)
+        state = self._materialize(node)
+        self.expanded.append(state)
+        return priority, node, state
+
+    def empty(self) -> bool:
+        """Return True if there are no packed nodes left."""
+        return not self.heap
+
+    def qsize(self) -> int:
+        """Return the number of packed nodes."""
+        return len(self.heap)
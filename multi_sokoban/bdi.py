@@ -1,8 +1,10 @@
 """Components of the BDI loop."""
+from array import array
 from copy import deepcopy
 from typing import Callable, Dict, List, Tuple
 
 from .actions import StateConcurrent, StateInit
+from .deadlocks import DeadlockStore
 from .heuristics import EasyRule, GoAway
 from .memory import MAX_USAGE, get_usage
 from .strategy import BestFirstSearch
@@ -49,6 +51,9 @@ class Message:
                 a replan
         time: List[(int, (row, col))]
             time when the agent solves the problem at
+        new_goal: Tuple
+            goal the requester wants to add to the other agent, forwarded with
+            the replan of a corrupt message
 
         """
         self.object_problem = object_problem
@@ -58,6 +63,7 @@ class Message:
         self.receiver = receiver
         self.header = header
         self.time = time
+        self.new_goal = new_goal
         self.agent = agent
         if header in [HEADER.replan, HEADER.update] and time is None:
             raise IncorrectTask("Solutions to SOS messages require a time!")
@@ -90,11 +96,21 @@ class Agent:
     saved_solution: List
         solution as a path of actions. Used to avoid recomputing solutions when
         not required. `None` if the solution has not been found.
+    deadlocks: DeadlockStore
+        patterns of the tasks known to be unsolvable, learned when a search
+        runs out of nodes. `None` to neither check nor learn them
+    trace: frozenset
+        cells next to the boxes that block the task when the last search
+        started from a deadlock and only walked, see track_back()
 
     """
 
     def __init__(
-        self, task: StateInit, strategy: BestFirstSearch, heuristic: Callable = None,
+        self,
+        task: StateInit,
+        strategy: BestFirstSearch,
+        heuristic: Callable = None,
+        deadlocks: DeadlockStore = None,
     ):
         """Initialize the agent wit a task."""
         self.task = task
@@ -108,6 +124,8 @@ class Agent:
         self.status = STATUS.init
         self.stored_message = False
         self.saved_solution = None
+        self.deadlocks = deadlocks
+        self.trace = frozenset()
 
     def solve(self, inbox: List[Message]) -> Tuple[List, Message]:
         """Solve the tasks by search and communicate.
@@ -141,7 +159,7 @@ class Agent:
         if not recompute and self.status != STATUS.init:
             # avoid recomputing solutions when not needed
             println(f"Agent({self.name}) not recomputing")
-            return [], self.broadcast()
+            return array("B"), self.broadcast()
         # execute intention
         searcher = self.strategy(self.task, self.heuristic)
         println(
@@ -172,7 +190,9 @@ class Agent:
                     pos = self.task.getGoalsByKey(own_box.lower())[0][0]
                     object_problem = own_box
         # remove the object in next step and solve
-        self.task.concurrent[self.task.t + 1] = {box: [None, index]}
+        self.task.concurrent = self.task.concurrent.merged(
+            {self.task.t + 1: {box: [None, index]}}
+        )
         searcher = self.strategy(self.task, self.heuristic)
         path = self.search(searcher)
         self.stored_message.header = HEADER.corrupt
@@ -333,14 +353,14 @@ class Agent:
         if not looking_for:
             looking_for = self.name
         explored = self.task.explored
-        # set -> list -> dict (key -> list -> (pos, color))
-        trace = []
-        for minrep in explored:
-            exp = eval(minrep)
-            for object_dict in exp:
-                key = list(object_dict)[0]
-                if key == self.name:
-                    trace.append(object_dict[key][0][0])
+        # dict (hash -> list -> (agents, boxes)) -> dict (key -> (pos, color))
+        trace = list(self.trace) if looking_for == self.name else []
+        # the push-level search keeps the regions its agents walked apart
+        trace.extend(self.task.walked.get(looking_for, ()))
+        for entries in explored.values():
+            for agents, _ in entries:
+                if looking_for in agents:
+                    trace.append(agents[looking_for][0][0])
         return trace
 
     def _identify_problem(self) -> str:
@@ -352,11 +372,12 @@ class Agent:
             goal and color as strings of the block which is blocking the agent
 
         """
+        # boxes another agent took off the map have no position
         boxes = [
             [box, pos_color[i][0], pos_color[i][1], i]
             for box, pos_color in self.task.boxes.items()
             for i in range(len(pos_color))
-            if pos_color[0][1] != self.color
+            if pos_color[0][1] != self.color and pos_color[i][0] is not None
         ]
         agent_trace = self.track_back(self.name)
         for box in boxes:
@@ -380,46 +401,70 @@ class Agent:
                 strategy.heuristic = GoAway()
                 strategy.leaf = strategy.leaf.advance()
                 # strategy = self.strategy(strategy.leaf, self.heuristic)
-        if strategy.leaf.isGoalState():
+        root = strategy.leaf
+        self.trace = frozenset()
+        if root.isGoalState():
             println(f"Agent {self.name}: state is Goal state (0 nodes explored)!")
-            return []
-        while not strategy.leaf.isGoalState():
-            if iterations == 1000:
-                println(f"{strategy.count} nodes explored")
-                iterations = 0
-
-            if get_usage() > MAX_USAGE:
-                raise ResourceLimit("Maximum memory usage exceeded.")
-                return None
-
-            strategy.explore_and_add()
-
-            if strategy.frontier_empty():
-                if (
-                    isinstance(strategy.leaf, StateConcurrent)
-                ):
-                    # look for events in the future and search again
-                    println("Advancing!")
-                    strategy.leaf = strategy.leaf.advance()
-                    println(strategy.leaf)
-                    continue
-                println(
-                    f"Agent {self.name}: Frontier empty! ({strategy.count} "
-                    f"nodes explored)"
-                )
-                self.task = strategy.leaf
-                return None
-
-            strategy.get_and_remove_leaf()
-
-            if strategy.leaf.isGoalState():
-                println(
-                    f"Agent {self.name}: Solution found with "
-                    f"{len(strategy.leaf.explored)} nodes explored"
-                )
-                println(strategy.heuristic)
-                self.frontier = strategy.frontier
-                self.task = strategy.leaf
-                return strategy.walk_best_path()
-
-            iterations += 1
+            return array("B")
+        # a frozen box never reaches its goal and neither does a known deadlock:
+        # only walk, the trace keeps the cells next to the blockers. Moves never
+        # freeze a box, see StateInit.deadlocked(), so the root is checked once
+        # instead of every child; the flag is on the context the task shares
+        # with its copies, it only holds while this search runs
+        self.trace = root.deadlocked()
+        if not self.trace and self.deadlocks is not None:
+            self.trace = self.deadlocks.deadlocked(root)
+            if self.trace:
+                println(f"Agent {self.name}: known deadlock, only walking")
+        root.context.frozen = bool(self.trace)
+        try:
+            # an empty frontier proves the root unsolvable if nothing was explored
+            fresh = not root.explored
+            while not strategy.leaf.isGoalState():
+                if iterations == 1000:
+                    println(f"{strategy.count} nodes explored")
+                    iterations = 0
+
+                if get_usage() > MAX_USAGE:
+                    raise ResourceLimit("Maximum memory usage exceeded.")
+                    return None
+
+                strategy.explore_and_add()
+
+                if strategy.frontier_empty():
+                    if (
+                        isinstance(strategy.leaf, StateConcurrent)
+                        and strategy.leaf.AdvancePrec()
+                    ):
+                        # look for events in the future and search again
+                        println("Advancing!")
+                        strategy.leaf = strategy.leaf.advance()
+                        println(strategy.leaf)
+                        continue
+                    println(
+                        f"Agent {self.name}: Frontier empty! ({strategy.count} "
+                        f"nodes explored)"
+                    )
+                    if self.deadlocks is not None and fresh:
+                        self.deadlocks.learn(root, root.explored)
+                    self.task = strategy.leaf
+                    return None
+
+                strategy.get_and_remove_leaf()
+
+                if strategy.leaf.isGoalState():
+                    println(
+                        f"Agent {self.name}: Solution found with "
+                        f"{len(strategy.leaf.explored)} nodes explored "
+                        f"({strategy.leaf.context.skipped} duplicates never allocated)"
+                    )
+                    println(strategy.heuristic)
+                    self.frontier = strategy.frontier
+                    # push-level states turn their walks into Moves here
+                    strategy.leaf = strategy.leaf.unfold()
+                    self.task = strategy.leaf
+                    return strategy.walk_best_path()
+
+                iterations += 1
+        finally:
+            root.context.frozen = False
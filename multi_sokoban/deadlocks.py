@@ -0,0 +1,154 @@
+"""Box patterns proven unsolvable by a search, kept on disk per wall layout."""
+import hashlib
+import os
+import pickle
+from typing import Dict
+
+from .actions import StateConcurrent, StateInit, StateJoint, StatePush
+
+
+def _cell(pos) -> tuple:
+    """Return `pos` as plain ints, so the digests do not depend on numpy."""
+    return int(pos[0]), int(pos[1])
+
+
+class DeadlockStore:
+    """Box patterns around the single agent tasks whose frontier ran empty.
+
+    A push is undone by a pull and the other way round, so the nodes a
+    task reaches are all unsolvable once its frontier runs empty, and a
+    deadlock shows first on the state the search started from. The search
+    only looked at a window of the level: the cells the agent walked to,
+    the cells next to them and the cells a push from there reaches, where
+    every box it moved stayed, plus the goal cells it tested. A pattern is
+    the boxes in that window. Another state is a deadlock when its agent
+    reaches the same region, its goals and its number of boxes of each
+    letter are the same, and its window holds the same boxes, whatever
+    lies outside the window. The region is keyed by its smallest cell, so
+    states whose agent starts anywhere in it share the pattern. The cells
+    the agent walked to are kept too, the blockers are next to them.
+
+    The patterns of a level are pickled in `directory`, one file per wall
+    layout, so later runs on the level start with them.
+
+    Attributes
+    ----------
+    path: str
+        file of the patterns of the layout
+    patterns: Dict
+        digest -> list of (window, boxes, walked cells), frozensets of
+        cells, of (cell, letter) and of cells
+
+    """
+
+    # bumped when the patterns kept on disk change
+    version = 2
+
+    def __init__(self, directory: str, layout):
+        """Load the patterns learned on the walls of `layout`, if any."""
+        walls = hashlib.blake2b(repr(layout.shape).encode(), digest_size=16)
+        walls.update(layout.tobytes())
+        name = f"{walls.hexdigest()}-{self.version}.pkl"
+        self.path = os.path.join(directory, name)
+        self.patterns = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                self.patterns = pickle.load(f)
+
+    @staticmethod
+    def learns(state: StateInit) -> bool:
+        """Tell if an empty frontier from `state` proves it unsolvable.
+
+        Concurrent states depend on a timeline, the push backend gives up
+        states with its corrals, frozen searches only walk and macros look at
+        tunnel cells the explored table does not keep.
+        """
+        return (
+            len(state.agents) == 1
+            and not state.context.frozen
+            and not state.context.macros
+            and not isinstance(state, (StateConcurrent, StateJoint, StatePush))
+        )
+
+    @staticmethod
+    def digest(state: StateInit) -> str:
+        """Hash the agent's color and region, the goals and the box counts.
+
+        The number of boxes of a letter decides which cells are dead for it.
+        """
+        ((agtkey, ((_, color),)),) = state.agents.items()
+        region = min(StatePush.reach(state, agtkey))
+        goals = sorted(
+            (str(key), _cell(pos))
+            for key, records in state.goals.items()
+            for pos, _ in records
+        )
+        counts = sorted(
+            (str(key), len(records)) for key, records in state.boxes.items()
+        )
+        pattern = repr((str(color), _cell(region), goals, counts)).encode()
+        return hashlib.blake2b(pattern, digest_size=16).hexdigest()
+
+    @staticmethod
+    def walked(state: StateInit, explored: Dict) -> frozenset:
+        """Return the cells the agent walked to in the search `explored`."""
+        ((agtkey, ((agtpos, _),)),) = state.agents.items()
+        walked = {_cell(agtpos)}
+        for entries in explored.values():
+            for agents, _ in entries:
+                walked.add(_cell(agents[agtkey][0][0]))
+        return frozenset(walked)
+
+    @staticmethod
+    def window(state: StateInit, walked: frozenset) -> frozenset:
+        """Return the cells the search from `state` looked at.
+
+        An agent looks at its neighbours and, to push, at theirs; the goal
+        test looks at the goal cells.
+        """
+        steps = state.steps
+        cells = set()
+        for pos in walked:
+            for cell in steps[pos]:
+                if cell is not None:
+                    cells.add(cell)
+                    cells.update(steps[cell])
+        cells.discard(None)
+        cells.update(pos for records in state.goals.values() for pos, _ in records)
+        return frozenset(_cell(cell) for cell in cells)
+
+    @staticmethod
+    def boxes(state: StateInit, window: frozenset) -> frozenset:
+        """Return the (cell, letter) of the boxes of `state` in `window`."""
+        boxes = set()
+        for cell in window:
+            key = state.occupied.get(cell)
+            if key is not None and not key.isnumeric():
+                boxes.add((cell, str(key)))
+        return frozenset(boxes)
+
+    def deadlocked(self, state: StateInit) -> frozenset:
+        """Return the cells walked to in the pattern `state` matches, if any."""
+        if not self.learns(state):
+            return frozenset()
+        for window, boxes, walked in self.patterns.get(self.digest(state), ()):
+            if self.boxes(state, window) == boxes:
+                return walked
+        return frozenset()
+
+    def learn(self, state: StateInit, explored: Dict):
+        """Keep `state` as a deadlock, `explored` being its whole search."""
+        if not self.learns(state):
+            return
+        walked = self.walked(state, explored)
+        window = self.window(state, walked)
+        pattern = window, self.boxes(state, window), walked
+        known = self.patterns.setdefault(self.digest(state), [])
+        if pattern in known:
+            return
+        known.append(pattern)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # write aside and rename, other agents may be reading the file
+        with open(f"{self.path}.{os.getpid()}", "wb") as f:
+            pickle.dump(self.patterns, f)
+        os.replace(f"{self.path}.{os.getpid()}", self.path)
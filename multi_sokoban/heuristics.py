@@ -1,6 +1,6 @@
 """Heuristics for Best First Search."""
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Callable, List
 import numpy as np
 import networkx as nx
 from utils import println
@@ -14,6 +14,73 @@ def manha_dist(a, b):
     return abs(x1 - x2) + abs(y1 - y2)
 
 
+class Distances:
+    """Shortest path lengths around the walls of a level.
+
+    A table holds the number of steps from every cell to a given cell as
+    int16, -1 where there is no path. The tables of the goal cells are
+    built together by a multi-source breadth first search when the level
+    is parsed, the other ones once they are asked for. Boxes and agents
+    are not obstacles, the tables only depend on the walls. Cells with no
+    path between them are `unreachable` steps apart, more than any path:
+    walls never move, so the cost is the same in every state of a search
+    and a box is never led towards a goal it cannot reach.
+
+    Attributes
+    ----------
+    free: np.array
+        boolean map, `True` where there is no wall
+    tables: dict
+        cell -> distance table to that cell
+    unreachable: int
+        steps between cells with no path between them
+
+    """
+
+    def __init__(self, walls: np.array, cells: List):
+        """Build the tables of `cells` on the map `walls`."""
+        self.free = ~walls
+        self.tables = {}
+        self.unreachable = int(walls.size)
+        if cells:
+            self.tables.update(zip(cells, self.bfs(cells)))
+
+    def __deepcopy__(self, memo):
+        """Share the tables between the copies of a task."""
+        return self
+
+    def bfs(self, cells: List) -> np.array:
+        """Return the (len(cells), rows, cols) tables of `cells`.
+
+        Every search advances at once: a step shifts all the frontiers by a
+        cell in the four directions.
+        """
+        free = self.free
+        tables = np.full((len(cells),) + free.shape, -1, dtype=np.int16)
+        frontier = np.zeros(tables.shape, dtype=bool)
+        for i, (row, col) in enumerate(cells):
+            frontier[i, row, col] = True
+        dist = 0
+        while frontier.any():
+            tables[frontier] = dist
+            reached = np.zeros_like(frontier)
+            reached[:, 1:, :] |= frontier[:, :-1, :]
+            reached[:, :-1, :] |= frontier[:, 1:, :]
+            reached[:, :, 1:] |= frontier[:, :, :-1]
+            reached[:, :, :-1] |= frontier[:, :, 1:]
+            frontier = reached & free & (tables < 0)
+            dist += 1
+        return tables
+
+    def __call__(self, a, b) -> int:
+        """Return the steps between `a` and `b`, see `unreachable`."""
+        table = self.tables.get(b)
+        if table is None:
+            table = self.tables[b] = self.bfs([b])[0]
+        dist = table[a]
+        return int(dist) if dist >= 0 else self.unreachable
+
+
 class Heuristics(ABC):
     """Class for defining heuristics."""
 
@@ -22,11 +89,17 @@ class Heuristics(ABC):
         """Call method, compute `heuristics` of List `states`."""
         return
 
+    @staticmethod
+    def distance(state) -> Callable:
+        """Return the distance of the level of `state`, see Distances."""
+        distances = state.context.distances
+        return manha_dist if distances is None else distances
+
 
 class EasyRule(Heuristics):
     """Simple heuristics.
 
-    Computes Manhattan distance for:
+    Computes the walking distance, see Distances, for:
     * Boxes to goals.
     * Agents to boxes.
     """
@@ -39,6 +112,7 @@ class EasyRule(Heuristics):
             return None
 
         for state in states:
+            dist = self.distance(state)
             box_goal_cost = 0
             agt_box_cost = 0
             agt_box_costs = []
@@ -55,14 +129,14 @@ class EasyRule(Heuristics):
                         if goal_color in state.agentColor:
                             agent_keys = state.getAgentsByColor(goal_color)
 
-                            if manha_dist(goal_pos, box_pos) == 0:
+                            if goal_pos == box_pos:
                                 continue
 
                             for agent_key in agent_keys:
                                 agentPos = state.getAgentsByKey(agent_key)[0][0]
-                                agt_box_costs.append(manha_dist(agentPos, box_pos))
+                                agt_box_costs.append(dist(agentPos, box_pos))
 
-                        box_goal_costs.append(manha_dist(box_pos, goal_pos))
+                        box_goal_costs.append(dist(box_pos, goal_pos))
 
                     if len(box_goal_costs) > 0:
                         box_goal_cost += min(box_goal_costs)
@@ -77,7 +151,7 @@ class WeightedRule(Heuristics):
     """Weighted heuristics.
 
     The distance from a box to a box is weigthed more (used for communication).
-    Computes Manhattan distance for:
+    Computes the walking distance, see Distances, for:
     * Boxes to goals.
     * Agents to boxes.
     """
@@ -94,6 +168,7 @@ class WeightedRule(Heuristics):
             return None
 
         for state in states:
+            dist = self.distance(state)
             box_goal_cost = 0
             agt_box_cost = 0
             agt_box_costs = []
@@ -109,14 +184,14 @@ class WeightedRule(Heuristics):
                         # only take agents with the same color as goalColor
                         agent_keys = state.getAgentsByColor(goal_color)
 
-                        if manha_dist(goal_pos, box_pos) == 0:
+                        if goal_pos == box_pos:
                             continue
 
                         for agent_key in agent_keys:
                             agentPos = state.getAgentsByKey(agent_key)[0][0]
-                            agt_box_costs.append(manha_dist(agentPos, box_pos))
+                            agt_box_costs.append(dist(agentPos, box_pos))
 
-                        box_goal_costs.append(manha_dist(box_pos, goal_pos))
+                        box_goal_costs.append(dist(box_pos, goal_pos))
 
                     if len(box_goal_costs) > 0:
                         box_cost = min(box_goal_costs)
@@ -134,7 +209,7 @@ class GoAway(Heuristics):
     """GoAway heuristics.
 
     The distance from a box to a box is weigthed more (used for communication).
-    Computes Manhattan distance for:
+    Computes the walking distance, see Distances, for:
     * Boxes to goals.
     * Agents to boxes.
     """
@@ -147,6 +222,7 @@ class GoAway(Heuristics):
             return None
 
         for state in states:
+            dist = self.distance(state)
             box_goal_cost = 0
             agt_box_cost = 0
             agt_box_costs = []
@@ -162,14 +238,14 @@ class GoAway(Heuristics):
                         # only take agents with the same color as goalColor
                         agent_keys = state.agents.keys()
 
-                        if manha_dist(goal_pos, box_pos) == 0:
+                        if goal_pos == box_pos:
                             continue
 
                         for agent_key in agent_keys:
                             agentPos = state.getAgentsByKey(agent_key)[0][0]
-                            agt_box_costs.append(-10 * manha_dist(agentPos, box_pos))
+                            agt_box_costs.append(-10 * dist(agentPos, box_pos))
 
-                        box_goal_costs.append(manha_dist(box_pos, goal_pos))
+                        box_goal_costs.append(dist(box_pos, goal_pos))
 
                         box_goal_cost += min(box_goal_costs)
                 if len(agt_box_costs) > 0:
@@ -197,6 +273,9 @@ class dGraph(Heuristics):
         self.map = state.map
         self.uniqueCorners = set()
         self.poses = []
+        # scratch of the path parts of the state being evaluated
+        self.currentPath = []
+        self.prevKeypoints = []
         self.graph = self.build_graph(state.map)
         self.boxes = {}
 
@@ -463,8 +542,8 @@ class dGraph(Heuristics):
         GTemp = copy.deepcopy(self.graph)
         # println(self.poses, self.poses[combId][pathId])
         startPos, endPos = self.poses[combId][pathId]
-        currentPath = state.currentPath[combId][pathId]
-        prevKeypoints = state.prevKeypoints[combId][pathId]
+        currentPath = self.currentPath[combId][pathId]
+        prevKeypoints = self.prevKeypoints[combId][pathId]
         #  println(" start", startPos,endPos, state.currentPath, startId, endId)
         if (
             currentPath is not None
@@ -539,14 +618,14 @@ class dGraph(Heuristics):
 
     def initializeGraphAttributes(self, state, subGoal, i):
         self.poses[i] = subGoal
-        if state.currentPath[i] is None:
-            state.currentPath[i] = [None] * len(subGoal)
-            state.prevKeypoints[i] = [None] * len(subGoal)
+        if self.currentPath[i] is None:
+            self.currentPath[i] = [None] * len(subGoal)
+            self.prevKeypoints[i] = [None] * len(subGoal)
 
     def initializeGraphSizes(self, state, size):
         self.poses = [None] * size
-        state.currentPath = [None] * size
-        state.prevKeypoints = [None] * size
+        self.currentPath = [None] * size
+        self.prevKeypoints = [None] * size
 
     def __call__(self, states: List):
         """Calculate heuristic for states in place."""
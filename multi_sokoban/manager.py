@@ -1,10 +1,12 @@
 """Task sharing MA communication."""
+from array import array
 from copy import deepcopy
 from typing import Callable, List
 
-from .actions import StateInit
+from .actions import COMMANDS, NOOP, StateInit, StateJoint
 from .bdi import Agent, Message
-from .heuristics import dGraph
+from .deadlocks import DeadlockStore
+from .heuristics import EasyRule, dGraph
 from .resultsharing import Resultsharing
 from .strategy import BestFirstSearch
 from .utils import HEADER, STATUS, println
@@ -35,14 +37,29 @@ class Manager:
     inbox: List[Message]
         List of OK `Message`s (see multi_sokoban/bdi.py) that the agents
         generate when they solve a request of another agent.
+    joint: bool
+        if colliding agents are planned together as a group instead of
+        exchanging replan messages, see plan_jointly()
+    groups: dict
+        agent names as keys and the group of agents planned jointly with
+        them as values
+    deadlocks: DeadlockStore
+        patterns of unsolvable tasks shared by the agents, `None` if off
 
     """
 
+    # groups beyond this size go back to the replan messages
+    max_group = 3
+    # rounds of result sharing before giving up on the collisions
+    max_rounds = 100
+
     def __init__(
         self,
         top_problem: StateInit,
         strategy: BestFirstSearch,
         heuristic: Callable = None,
+        joint: bool = False,
+        deadlocks: DeadlockStore = None,
     ):
         """Initialize with the whole problem definition `top_problem`."""
         self.top_problem = top_problem
@@ -53,15 +70,19 @@ class Manager:
         self.nodes_explored = 0
         self.paths = {}
         self.inbox = []
+        self.joint = joint
+        self.groups = {}
+        self.deadlocks = deadlocks
 
 
     def run(self) -> List:
         """Perform the task sharing."""
         self.divide_problem()
 
-        colliding = True
         new_time = 0
-        while colliding is not None:
+        # collisions met so far, with the paths they were found on
+        seen = set()
+        for _ in range(self.max_rounds):
             println("===================TASK SHARING!===================")
             self.solve_world()
             println(f"Solution: {self.join_tasks()}")
@@ -69,16 +90,30 @@ class Manager:
             println("==================RESULT SHARING!==================")
             colliding = self.solveCollision(new_time)
             println(colliding)
-            if colliding is not None:
-                # we have all the information to do direct contracting
-                self.pack_collision(colliding)
-                time = self.inbox[0].time
-                curr_pos = time[0][1]
-                for event in time:
-                    pos = event[1]
-                    if curr_pos[0] != pos[0] or curr_pos[1] != pos[1]:
-                        new_time = event[0]
-                        break
+            if colliding is None:
+                break
+            met = (colliding, tuple(bytes(path) for path in self.solutions))
+            # the replan left the paths as they were, another message would
+            # only meet the same collision again: the agents must be planned
+            # together, or the collision cannot be solved
+            if self.joint or met in seen:
+                if self.plan_jointly(str(colliding[0]), str(colliding[1])):
+                    continue
+                if met in seen:
+                    println(f"Giving up on the collision {colliding}")
+                    break
+            seen.add(met)
+            # we have all the information to do direct contracting
+            self.pack_collision(colliding)
+            time = self.inbox[0].time
+            curr_pos = time[0][1]
+            for event in time:
+                pos = event[1]
+                if curr_pos[0] != pos[0] or curr_pos[1] != pos[1]:
+                    new_time = event[0]
+                    break
+        else:
+            println(f"Giving up after {self.max_rounds} rounds of result sharing")
 
         return self.join_tasks()
 
@@ -97,7 +132,9 @@ class Manager:
                 self.agents[agent].add_task(task)
             else:
                 println("hello", self.heuristic)
-                self.agents[agent] = Agent(task, self.strategy, self.heuristic)
+                self.agents[agent] = Agent(
+                    task, self.strategy, self.heuristic, self.deadlocks
+                )
 
     def bidding(self, task: StateInit, agents: List[str]) -> str:
         """Request heuristic from the `agents` to solve a particular `task`."""
@@ -155,6 +192,46 @@ class Manager:
         rs = Resultsharing(self, [])
         return rs.findAndResolveCollision(new_time)
 
+    def plan_jointly(self, receiver: str, requester: str) -> bool:
+        """Replace the paths of two colliding agents by a joint plan.
+
+        The groups of both agents are merged and searched as one problem
+        with the goals of all of them (see StateJoint), so the paths of the
+        group cannot collide with each other. Returns `False` if the group
+        would be larger than `max_group` or has no joint plan, the
+        collision is then left to the replan messages.
+        """
+        group = self.groups.get(receiver, {receiver}) | self.groups.get(
+            requester, {requester}
+        )
+        if len(group) > self.max_group or group == self.groups.get(receiver):
+            return False
+        task = deepcopy(self.top_problem)
+        task.forget_exploration()
+        goals = set()
+        for name in group:
+            goals |= set(self.agents[name].init_task.goals)
+        for goal in list(task.goals):
+            if goal not in goals:
+                task.deleteGoal(goal)
+        for name in list(task.agents):
+            if name not in group:
+                task.deleteAgent(name)
+        println(f"Planning agents {sorted(group)} jointly")
+        task = StateJoint(task)
+        planner = Agent(task, self.strategy, EasyRule())
+        path = planner.search(self.strategy(task, planner.heuristic))
+        self.nodes_explored += len(task.explored)
+        if path is None:
+            return False
+        for name, path in planner.task.jointPaths().items():
+            self.paths[name] = path
+            self.groups[name] = group
+        self.solutions = [self.paths[name] for name in self.sort_agents()]
+        # the messages were about the paths that were just replaced
+        self.inbox = []
+        return True
+
     def pack_collision(self, colliding: List):
         """Write a message to inbox from self.solveCollision results."""
         receiver = str(colliding[0])
@@ -180,7 +257,7 @@ class Manager:
             time[i][0] += span
             time_agent[i][0] += span
         # to get the right times, we need to trim artificial NoOps
-        while self.paths[receiver][-1] == "NoOp":
+        while self.paths[receiver][-1] == NOOP:
             self.paths[receiver].pop()
         self.inbox.append(
             Message(
@@ -224,18 +301,20 @@ class Manager:
         list of actions to the best solution
 
         """
-        paths = deepcopy(self.solutions)
+        paths = [array("B", path) for path in self.solutions]
         # make sure that all paths has the same length
         sol_len = max([len(path) for path in paths])
         for i in range(len(paths)):
             while sol_len > len(paths[i]):
-                paths[i].append("NoOp")
+                paths[i].append(NOOP)
         
         if len(paths) < len(self.top_problem.agents):
             missing = set(self.top_problem.agents.keys()) ^ {
                 agent for agent in self.agents
             }
-            paths.insert(int(list(missing)[0]), ["NoOp"] * len(paths[0]))
+            paths.insert(int(list(missing)[0]), array("B", [NOOP]) * len(paths[0]))
 
+        # the opcodes only become server commands here
+        paths = [[COMMANDS[code] for code in path] for path in paths]
         println(paths)
         return [";".join(actions) for actions in zip(*paths)]
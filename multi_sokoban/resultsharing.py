@@ -1,3 +1,4 @@
+from .actions import ACTIONS, NOOP
 from .utils import println
 import copy
 import numpy as np
@@ -57,10 +58,10 @@ class Resultsharing:
             for i in range(len(self.pos[agt]) - 1):
                 if self.pos[agt][i] == self.pos[agt][i + 1]:
                     if len(self.paths[agt]) > i:
-                        if self.paths[agt][i] != "NoOp":
-                            self.paths[agt].insert(i, "NoOp")
+                        if self.paths[agt][i] != NOOP:
+                            self.paths[agt].insert(i, NOOP)
                     else:
-                        self.paths[agt].append("NoOp")
+                        self.paths[agt].append(NOOP)
                     # if len(self.paths[agt]) > 0:
                     #     self.paths[agt].insert(i, "NoOp")
                     # else:
@@ -321,31 +322,29 @@ def convert2pos(manager, initPos, paths):
         if agt is None:
             continue
         for action in agt:
-            prefix = action[0]
+            kind, step1, step2 = ACTIONS[action]
             if type(pos[i][-1]) == list:
                 [row, col] = pos[i][-1][0]
             else:
                 [row, col] = pos[i][-1]
-            if prefix == "N":
+            if kind == "NoOp":
                 pos[i].append([(row, col)])
-            elif prefix == "M":
-                [drow, dcol] = manager.top_problem.dir[action[-2:-1]]
+            elif kind == "Move":
+                [drow, dcol] = step1
                 pos[i].append([(row + drow, col + dcol)])
-            elif prefix == "P":
-                if action[0:4] == "Push":
-                    [drow1, dcol1] = manager.top_problem.dir[action[-4:-3]]
-                    [drow2, dcol2] = manager.top_problem.dir[action[-2:-1]]
-
-                    [row1, col1] = (row + drow1, col + dcol1)
-                    [row2, col2] = (row1 + drow2, col1 + dcol2)
-                    pos[i].append([(row1, col1), (row2, col2)])
-                else:
-                    [drow1, dcol1] = manager.top_problem.dir[action[-4:-3]]
-                    [drow2, dcol2] = manager.top_problem.dir[action[-2:-1]]
+            elif kind == "Push":
+                [drow1, dcol1] = step1
+                [drow2, dcol2] = step2
+
+                [row1, col1] = (row + drow1, col + dcol1)
+                [row2, col2] = (row1 + drow2, col1 + dcol2)
+                pos[i].append([(row1, col1), (row2, col2)])
+            else:
+                [drow1, dcol1] = step1
 
-                    [row1, col1] = (row + drow1, col + dcol1)
-                    [row2, col2] = (row, col)
-                    pos[i].append([(row1, col1), (row2, col2)])
+                [row1, col1] = (row + drow1, col + dcol1)
+                [row2, col2] = (row, col)
+                pos[i].append([(row1, col1), (row2, col2)])
 
         i += 1
 
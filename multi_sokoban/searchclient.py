@@ -8,11 +8,33 @@ from typing import List
 import numpy as np
 
 from _io import TextIOWrapper
-from multi_sokoban.actions import StateInit
-from multi_sokoban.strategy import BestFirstSearch, aStarSearch, greedySearch
+from multi_sokoban.actions import (
+    WALL,
+    StateBitboard,
+    StateDelta,
+    StateInit,
+    StatePush,
+)
+from multi_sokoban.strategy import (
+    BestFirstSearch,
+    aStarArenaSearch,
+    aStarSearch,
+    greedyArenaSearch,
+    greedySearch,
+)
+from multi_sokoban.deadlocks import DeadlockStore
 from multi_sokoban.manager import Manager
 from multi_sokoban.utils import println
-from heuristics import dGraph, EasyRule
+from heuristics import Distances, dGraph, EasyRule
+
+
+# state classes selectable with --backend
+BACKENDS = {
+    "records": StateInit,
+    "bitboard": StateBitboard,
+    "delta": StateDelta,
+    "push": StatePush,
+}
 
 
 class ParseError(Exception):
@@ -24,16 +46,39 @@ class ParseError(Exception):
 class SearchClient:
     """Contain the AI, strategy and parsing."""
 
-    def __init__(self, server_messages: TextIOWrapper, strategy: str):
-        """Init object."""
+    def __init__(
+        self,
+        server_messages: TextIOWrapper,
+        strategy: str,
+        backend: str = "records",
+        macros: bool = False,
+        sipp: bool = False,
+        joint: bool = False,
+        deadlocks: str = None,
+    ):
+        """Init object, `backend` selects the state class, see BACKENDS.
+
+        With `macros`, walks, pushes and pulls along a tunnel and into a goal
+        room are a single successor. With `sipp`, agents replanning around
+        other agents wait until the next change of the world in a single
+        successor. With `joint`, agents whose paths collide are planned
+        together. With `deadlocks`, the tasks proven unsolvable are kept in
+        that directory.
+        """
+        self.state_class = BACKENDS[backend]
         self.colors_re = re.compile(r"^([a-z]+):\s*([0-9])\s*")
         self.invalid_re = re.compile(r"[^A-Za-z0-9+]")
         self.colors = {}
         self.initial_state = self.parse_map(server_messages)
+        self.initial_state.context.macros = macros
+        self.initial_state.context.sipp = sipp
+        self.joint = joint
+        self.deadlocks = None
+        if deadlocks is not None:
+            self.deadlocks = DeadlockStore(deadlocks, self.initial_state.layout)
         self._strategy = None
         self.heuristic = dGraph(self.initial_state)
         self.add_strategy(strategy)
-        sys.setrecursionlimit(1000000000)
 
     @property
     def strategy(self) -> BestFirstSearch:
@@ -51,6 +96,10 @@ class SearchClient:
                 raise NotImplementedError
             elif strategy == "greedy":
                 self._strategy = greedySearch
+            elif strategy == "astar-arena":
+                self._strategy = aStarArenaSearch
+            elif strategy == "greedy-arena":
+                self._strategy = greedyArenaSearch
 
     def add_strategy(self, strategy: str):
         """Initialize strategy, just for the __init__ method."""
@@ -107,7 +156,7 @@ class SearchClient:
         addMap just parses rigid positions (not agent and boxes), so
         get the positions of the agents and boxes and remove them from map
         """
-        state = StateInit()
+        state = self.state_class()
         all_objects = []
         agent_n_boxes = string.digits + string.ascii_uppercase
         possible_colors = set(self.colors.values())
@@ -123,31 +172,47 @@ class SearchClient:
                 if color in possible_colors:
                     state.addBox(obj, (row, col), color)
                 else:
-                    state.map[row, col] = "+"
+                    state.addWall((row, col))
         goals = string.ascii_uppercase
         all_objects = self._locate_objects(np.array(goal_state), goals)
         for obj, pos, color in all_objects:
             row, col = pos
             state.addGoal(obj, (row, col), color)
+        # once per level: cells where boxes of a letter can reach no goal and
+        # the walking distances to the goals, shared by every agent
+        state.context.buildDeadCells(state.boxes)
+        state.context.distances = Distances(
+            state.layout == WALL,
+            [pos for goals in state.goals.values() for pos, _ in goals],
+        )
         println(state)
         return state
 
     def _locate_objects(self, map: np.array, possible_objects: str) -> List:
         all_objects = []
-        # print(map, file=sys.stderr, flush=True)
-        for obj in possible_objects:
-            agent_pos = np.where(map == obj)
-            if len(agent_pos) > 0:
-                for x, y in zip(agent_pos[0], agent_pos[1]):
-                    color = self.colors[obj] if obj in self.colors else None
-                    all_objects.append([obj, (x, y), color])
-                map[agent_pos] = " "
+        # one pass over the code points of the map instead of one per object
+        codes = map.astype("<U1").view(np.uint32)
+        wanted = np.array([ord(obj) for obj in possible_objects], dtype=np.uint32)
+        rows, cols = np.nonzero(np.isin(codes, wanted))
+        # objects in the order of `possible_objects`, row-major for each object
+        found = sorted(zip(rows, cols), key=lambda p: possible_objects.index(map[p]))
+        for x, y in found:
+            obj = map[x, y]
+            color = self.colors[obj] if obj in self.colors else None
+            all_objects.append([obj, (x, y), color])
+        map[rows, cols] = " "
         return all_objects
 
     def search(self) -> List:
         """Apply search algorithm."""
         println(f"Starting search with strategy {self.strategy}.")
-        boss = Manager(self.initial_state, self.strategy, self.heuristic)
+        boss = Manager(
+            self.initial_state,
+            self.strategy,
+            self.heuristic,
+            self.joint,
+            self.deadlocks,
+        )
         paths = boss.run()
         nodes_explored = boss.nodes_explored
         return paths, nodes_explored
@@ -165,6 +230,36 @@ def parse_arguments() -> argparse.ArgumentParser:
         default=2048.0,
         help="The maximum memory usage allowed in MB (soft limit).",
     )
+    parser.add_argument(
+        "--backend",
+        choices=list(BACKENDS),
+        default="records",
+        help="State representation: plain records, bitboards for occupancy and"
+        " goal queries, occupancy delta-encoded against the parent, or push-level"
+        " nodes that only branch on box moves.",
+    )
+    parser.add_argument(
+        "--macros",
+        action="store_true",
+        help="Walk, push and pull through tunnels and fill goal rooms in a single"
+        " search step.",
+    )
+    parser.add_argument(
+        "--sipp",
+        action="store_true",
+        help="Wait for other agents through safe intervals when replanning.",
+    )
+    parser.add_argument(
+        "--joint",
+        action="store_true",
+        help="Plan colliding agents together, one agent's action at a time.",
+    )
+    parser.add_argument(
+        "--deadlocks",
+        metavar="<DIR>",
+        help="Keep the tasks proven unsolvable in this directory, per wall"
+        " layout, and skip their box moves in later runs.",
+    )
     strategy_group = parser.add_mutually_exclusive_group()
     strategy_group.add_argument(
         "-astar",
@@ -187,17 +282,41 @@ def parse_arguments() -> argparse.ArgumentParser:
         const="greedy",
         help="Use the Greedy strategy.",
     )
+    strategy_group.add_argument(
+        "-astar-arena",
+        action="store_const",
+        dest="strategy",
+        const="astar-arena",
+        help="Use the A* strategy with the frontier packed in a node arena.",
+    )
+    strategy_group.add_argument(
+        "-greedy-arena",
+        action="store_const",
+        dest="strategy",
+        const="greedy-arena",
+        help="Use the Greedy strategy with the frontier packed in a node arena.",
+    )
     args = parser.parse_args()
 
     return args
 
 
-def run_loop(strategy: str, memory: float):
+def run_loop(
+    strategy: str,
+    memory: float,
+    backend: str = "records",
+    macros: bool = False,
+    sipp: bool = False,
+    joint: bool = False,
+    deadlocks: str = None,
+):
     """Iterate over main loop Server->Client->Server."""
     global MAX_USAGE
     MAX_USAGE = memory
     server_messages = sys.stdin
-    client = SearchClient(server_messages, strategy)
+    client = SearchClient(
+        server_messages, strategy, backend, macros, sipp, joint, deadlocks
+    )
     solution, nodes_explored = client.search()
     if solution is None:
         println("Unable to solve level.")
@@ -221,4 +340,12 @@ def run_loop(strategy: str, memory: float):
 if __name__ == "__main__":
     args = parse_arguments()
     print("Karen\n", flush=True)
-    run_loop(args.strategy, args.max_memory)
+    run_loop(
+        args.strategy,
+        args.max_memory,
+        args.backend,
+        args.macros,
+        args.sipp,
+        args.joint,
+        args.deadlocks,
+    )
@@ -5,6 +5,7 @@ from typing import Callable
 
 from heuristics import EasyRule
 from multi_sokoban import actions
+from multi_sokoban.arena import NodeArena
 
 from utils import println
 
@@ -14,11 +15,15 @@ class BestFirstSearch(ABC):
 
     def __init__(self, init_state: actions.StateInit, heuristic: Callable = None):
         """Initialize strategy."""
-        self.frontier = PriorityQueue()
+        self.frontier = self.new_frontier(init_state)
         self.leaf = init_state
         self.count = 0
         self.heuristic = heuristic if heuristic else EasyRule()
 
+    def new_frontier(self, init_state: actions.StateInit):
+        """Return an empty frontier, a priority queue of (f, count, state)."""
+        return PriorityQueue()
+
     def get_and_remove_leaf(self):
         """Depend on the heuristic method."""
 
@@ -72,3 +77,27 @@ class aStarSearch(BestFirstSearch):
     def __str__(self):
         """Printable description."""
         return "A* Best First Search"
+
+
+class greedyArenaSearch(greedySearch):
+    """BFS with greedy, the frontier is packed in a NodeArena."""
+
+    def new_frontier(self, init_state: actions.StateInit):
+        """Return an empty NodeArena laid out after `init_state`."""
+        return NodeArena(init_state)
+
+    def __str__(self):
+        """Printable description."""
+        return "greedy Best First Search (node arena)"
+
+
+class aStarArenaSearch(aStarSearch):
+    """BFS with A*, the frontier is packed in a NodeArena."""
+
+    def new_frontier(self, init_state: actions.StateInit):
+        """Return an empty NodeArena laid out after `init_state`."""
+        return NodeArena(init_state)
+
+    def __str__(self):
+        """Printable description."""
+        return "A* Best First Search (node arena)"
@@ -48,7 +48,13 @@ def test(nr):
 
         print("\n\nthird iteration using the last leaf\n")
         [
-            print(child.map, child.prevAction, child.minimalRep(), " cost:", child.g,)
+            print(
+                child.map,
+                child.prevAction,
+                (child.agents, child.boxes),
+                " cost:",
+                child.g,
+            )
             for child in newState
         ]
 
@@ -98,7 +104,11 @@ def test(nr):
         print("\n\nthird iteration using the last leaf\n")
         [
             print(
-                child.map, child.actionPerformed, child.minimalRep(), " cost:", child.g,
+                child.map,
+                child.actionPerformed,
+                (child.agents, child.boxes),
+                " cost:",
+                child.g,
             )
             for child in newState
         ]
@@ -184,7 +194,7 @@ def test(nr):
             print(
                 child.map,
                 child.actionPerformed,
-                child.minimalRep(),
+                (child.agents, child.boxes),
                 " cost:",
                 child.g,
                 "   cost to goal:",
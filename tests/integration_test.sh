@@ -1,2 +1,4 @@
 #!/usr/bin/env sh
 ../exe_serve.sh SAD1.lvl -astar
+../exe_serve.sh SAKaren.lvl "-astar-arena --backend push"
+../exe_serve.sh MAAIFather_simple.lvl "-astar-arena --backend push"
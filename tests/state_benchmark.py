@@ -0,0 +1,64 @@
+"""Benchmark node generation of the search states.
+
+Expands the initial state of a level breadth first and reports the node
+generation rate and the memory retained by the generated nodes.
+
+    PYTHONPATH=.:multi_sokoban python tests/state_benchmark.py levels/SAKaren.lvl 20000
+
+A backend of `SearchClient`, e.g. `delta`, can be given as an extra argument.
+
+"""
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+from multi_sokoban.searchclient import BACKENDS, SearchClient
+
+
+def load(level: str, backend: str = "records"):
+    """Parse a level file into the initial state."""
+    with open(level) as server_messages:
+        return SearchClient(server_messages, "astar", backend).initial_state
+
+
+def generate(state, nodes: int):
+    """Expand breadth first until `nodes` children have been generated."""
+    frontier = deque([state])
+    generated = []
+    while frontier and len(generated) < nodes:
+        children = frontier.popleft().explore()
+        generated.extend(children)
+        frontier.extend(children)
+    return generated
+
+
+def benchmark(level: str, nodes: int = 20000, backend: str = "records"):
+    """Return nodes per second and MB per 100k nodes for `level`."""
+    state = load(level, backend)
+    start = time.perf_counter()
+    generated = generate(state, nodes)
+    elapsed = time.perf_counter() - start
+    rate = len(generated) / elapsed
+    del generated
+
+    state = load(level, backend)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    generated = generate(state, nodes)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    mb_per_100k = (after - before) / (1024 * 1024) * 100000 / len(generated)
+    return len(generated), rate, mb_per_100k
+
+
+if __name__ == "__main__":
+    backends = [arg for arg in sys.argv[1:] if arg in BACKENDS] or ["records"]
+    levels = [
+        arg for arg in sys.argv[1:] if not arg.isdigit() and arg not in BACKENDS
+    ]
+    nodes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    levels = levels or ["levels/SAKaren.lvl", "levels/MAKarlMarx.lvl"]
+    for level in levels:
+        count, rate, mb = benchmark(level, *nodes[:1], backends[0])
+        print(f"{level}: {count} nodes, {rate:.0f} nodes/s, {mb:.1f} MB/100k nodes")